@@ -7,9 +7,13 @@ __license__   = 'GPL v3'
 __docformat__ = 'restructuredtext en'
 
 import os
+import threading
+import time
 from hashlib import md5
 from zipfile import ZipFile
 from calibre_plugins.diaps_toolbag.utilities import is_py3
+from calibre_plugins.diaps_toolbag.tasks import TreeUnsupported
+from calibre_plugins.diaps_toolbag.resources.html_parser import CompiledCriteria
 
 if is_py3:
     text_type = str
@@ -21,16 +25,19 @@ else:
 try:
     from qt.core import (Qt, QVBoxLayout, QLabel, QCheckBox, QLineEdit, QTextEdit, QComboBox, QApplication,
                     QSizePolicy, QGroupBox, QPushButton, QDialogButtonBox, QHBoxLayout, QTextBrowser,
-                    QSpacerItem, QProgressDialog, QListWidget, QTimer, QSize, QDialog, QIcon, QUrl)
+                    QSpacerItem, QProgressDialog, QListWidget, QTimer, QSize, QDialog, QIcon, QUrl,
+                    QThread, QCompleter, pyqtSignal)
 except ImportError:
     try:
         from PyQt5.Qt import (Qt, QVBoxLayout, QLabel, QCheckBox, QLineEdit, QTextEdit, QComboBox, QApplication,
                         QSizePolicy, QGroupBox, QPushButton, QDialogButtonBox, QHBoxLayout, QTextBrowser,
-                        QSpacerItem, QProgressDialog, QListWidget, QTimer, QSize, QDialog, QIcon, QUrl)
+                        QSpacerItem, QProgressDialog, QListWidget, QTimer, QSize, QDialog, QIcon, QUrl,
+                        QThread, QCompleter, pyqtSignal)
     except ImportError:
         from PyQt4.Qt import (Qt, QVBoxLayout, QLabel, QCheckBox, QLineEdit, QTextEdit, QComboBox, QApplication,
                         QSizePolicy, QGroupBox, QPushButton, QDialogButtonBox, QHBoxLayout, QTextBrowser,
-                        QSpacerItem, QProgressDialog, QListWidget, QTimer, QSize, QDialog, QIcon, QUrl)
+                        QSpacerItem, QProgressDialog, QListWidget, QTimer, QSize, QDialog, QIcon, QUrl,
+                        QThread, QCompleter, pyqtSignal)
 
 from calibre.gui2 import error_dialog, choose_files, open_url
 from calibre.utils.config import config_dir
@@ -72,11 +79,17 @@ except NameError:
     pass  # load_translations() added in calibre 1.9
 
 class RemoveDialog(Dialog):
-    def __init__(self, parent):
+    # how often (ms) to look whether the tag index has finished updating
+    INDEX_INTERVAL = 250
+
+    def __init__(self, parent, index=None):
         from calibre_plugins.diaps_toolbag.span_div_config import plugin_prefs as prefs
         self.criteria = None
+        self.count_only = False
         self.prefs = prefs
         self.parent = parent
+        # the book's TagIndex, which may still be updating in the background
+        self.index = index
         self.help_file_name = '{0}_span_div_help.html'.format(PLUGIN_SAFE_NAME)
         self.taglist = self.prefs['taglist']
         Dialog.__init__(self, _('Edit Spans & Divs'), 'toolbag_spans_divs_dialog', parent)
@@ -133,8 +146,21 @@ class RemoveDialog(Dialog):
         srch_layout.addWidget(label)
         self.srch_txt = QLineEdit('', self)
         srch_layout.addWidget(self.srch_txt)
-        self.srch_method = QCheckBox(_('Regex'), self)
-        srch_layout.addWidget(self.srch_method)
+        # how the value is matched: the whole of it, any of the (space
+        # separated) tokens given, as with a class, or a regex
+        self.SRCH_METHODS = ['normal', 'token', 'regex']
+        self.method_combo = QComboBox()
+        srch_layout.addWidget(self.method_combo)
+        self.method_combo.addItems([_('Whole value'), _('Class token(s)'), _('Regex')])
+        self.method_combo.currentIndexChanged.connect(self.update_gui)
+        # With the tag index, the values the tag's attribute has in the book are
+        # offered while typing, and how many tags match is shown as it changes
+        self.completer = QCompleter([], self)
+        self.completer.setCaseSensitivity(Qt.CaseSensitive)
+        self.srch_txt.setCompleter(self.completer)
+        self.count_label = QLabel('', self)
+        layout.addWidget(self.count_label)
+        self.srch_txt.textChanged.connect(self.update_counts)
 
         newtag_layout = QHBoxLayout()
         layout.addLayout(newtag_layout)
@@ -158,25 +184,83 @@ class RemoveDialog(Dialog):
         self.copy_attr = QCheckBox(_('Copy existing attribute string'), self)
         self.copy_attr.stateChanged.connect(self.update_txt_box)
         newattr_layout.addWidget(self.copy_attr)
+        self.drop_tokens = QCheckBox(_('Only remove the matched token(s), keeping the rest'), self)
+        self.drop_tokens.stateChanged.connect(self.update_txt_box)
+        newattr_layout.addWidget(self.drop_tokens)
         if self.action_combo.currentIndex() == 0:
             self.copy_attr.setDisabled(True)
             self.newattr_txt.setDisabled(True)
+            self.drop_tokens.setDisabled(True)
 
         layout.addSpacing(10)
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        # Count the matches without changing anything
+        count_button = button_box.addButton(_('Count matches'), QDialogButtonBox.ActionRole)
+        count_button.clicked.connect(self._count_clicked)
         button_box.accepted.connect(self._ok_clicked)
         button_box.rejected.connect(self.reject)
         layout.addWidget(button_box)
 
+        if self.index is not None and self.index.busy():
+            self.index_timer = QTimer(self)
+            self.index_timer.timeout.connect(self.index_progress)
+            self.index_timer.start(self.INDEX_INTERVAL)
+        self.update_values()
+
+    def index_progress(self):
+        if not self.index.busy():
+            self.index_timer.stop()
+            self.update_values()
+
+    def current_method(self):
+        return self.SRCH_METHODS[self.method_combo.currentIndex()]
+
+    def current_attrib(self):
+        if self.attr_combo.currentIndex() == self.attr_combo.count()-1:
+            return None
+        return text_type(self.attr_combo.currentText())
+
+    def update_values(self):
+        if self.index is None:
+            return
+        attribute = self.current_attrib()
+        values = []
+        if attribute is not None and not self.index.busy():
+            values = self.index.values_of(text_type(self.tag_combo.currentText()), attribute)
+            if self.current_method() == 'token':
+                values = sorted(set(token for value in values for token in value.split()))
+        self.completer.model().setStringList(values)
+        self.update_counts()
+
+    def update_counts(self):
+        if self.index is None:
+            return
+        if self.index.busy():
+            return self.count_label.setText(_('Looking through the book...'))
+        attribute = self.current_attrib()
+        srch_str = text_type(self.srch_txt.text())
+        if attribute is not None and not srch_str:
+            return self.count_label.setText('')
+        try:
+            rule = CompiledCriteria(srch_str or None, self.current_method(), text_type(self.tag_combo.currentText()),
+                                    attribute)
+        except Exception:
+            return self.count_label.setText(_('Not a valid regular expression'))
+        total, files = self.index.count(rule)
+        if total:
+            self.count_label.setText(_('Found {0} time(s) in {1} file(s)').format(total, files))
+        else:
+            self.count_label.setText(_('Not found in the book'))
+
     def update_gui(self):
         if self.attr_combo.currentIndex() == self.attr_combo.count()-1:
             self.srch_txt.clear()
             self.srch_txt.setDisabled(True)
-            self.srch_method.setChecked(False)
-            self.srch_method.setDisabled(True)
+            self.method_combo.setCurrentIndex(0)
+            self.method_combo.setDisabled(True)
         else:
             self.srch_txt.setDisabled(False)
-            self.srch_method.setDisabled(False)
+            self.method_combo.setDisabled(False)
 
         self.newtag_combo.clear()
         self.newtag_combo.addItem(self.NO_CHANGE_STR)
@@ -193,8 +277,25 @@ class RemoveDialog(Dialog):
             self.newtag_combo.setDisabled(False)
             self.newattr_txt.setDisabled(False)
             self.copy_attr.setDisabled(False)
+        if self.action_combo.currentIndex() == 0 or self.current_method() != 'token':
+            self.drop_tokens.setChecked(False)
+            self.drop_tokens.setDisabled(True)
+        else:
+            self.drop_tokens.setDisabled(False)
+        self.update_txt_box()
+        self.update_values()
 
     def update_txt_box(self):
+        if self.drop_tokens.isChecked():
+            # the tag keeps the rest of its attributes as they are
+            self.copy_attr.setChecked(False)
+            self.copy_attr.setDisabled(True)
+            self.newattr_txt.clear()
+            self.newattr_txt.setDisabled(True)
+            return
+        if self.action_combo.currentIndex() == 0:
+            return
+        self.copy_attr.setDisabled(False)
         if self.copy_attr.isChecked():
             self.newattr_txt.clear()
             self.newattr_txt.setDisabled(True)
@@ -202,23 +303,24 @@ class RemoveDialog(Dialog):
             self.newattr_txt.setDisabled(False)
 
     def _ok_clicked(self):
+        self._finish(False)
+
+    def _count_clicked(self):
+        self._finish(True)
+
+    def _finish(self, count_only):
         if self.action_combo.currentIndex() == 0:
             action = 'delete'
         else:
             action = 'modify'
-        if self.attr_combo.currentIndex() == self.attr_combo.count()-1:
-            attribute = None
-        else:
-            attribute = text_type(self.attr_combo.currentText())
+        attribute = self.current_attrib()
         srch_str = text_type(self.srch_txt.displayText())
         if not len(srch_str):
             srch_str = None
-        if srch_str is None and attribute is not None:
+        srch_method = self.current_method()
+        if attribute is not None and (srch_str is None or (srch_method == 'token' and not srch_str.split())):
             return error_dialog(self.parent, _('Error'), '<p>{0}'.format(
                     _('Must enter a value for the attribute selected')), det_msg='', show=True)
-        srch_method = 'normal'
-        if self.srch_method.isChecked():
-            srch_method = 'regex'
         if self.newtag_combo.currentIndex() == 0:
             newtag = None
         else:
@@ -233,12 +335,17 @@ class RemoveDialog(Dialog):
         if not len(new_str):
             new_str = ''
 
-        self.criteria = (srch_str, srch_method, text_type(self.tag_combo.currentText()), attribute, action, newtag, new_str, copy_attr)
+        self.criteria = (srch_str, srch_method, text_type(self.tag_combo.currentText()), attribute, action, newtag, new_str, copy_attr,
+                         self.prefs['verbatim'], self.drop_tokens.isChecked())
+        self.count_only = count_only
         self.accept()
 
     def getCriteria(self):
         return self.criteria
 
+    def isCountOnly(self):
+        return self.count_only
+
     def help_link_activated(self, url):
         def get_help_file_resource():
             # Copy the HTML helpfile to the plugin directory each time the
@@ -303,6 +410,17 @@ class PunctDialog(Dialog):
         path_layout.addWidget(self.file_button)
         if not self.edu_quotes.isChecked() and not self.use_file.isChecked():
             self.file_button.setDisabled(True)
+        self.ignore_case = QCheckBox(_('Ignore case when matching exceptions'), self)
+        exceptions_group_box_layout.addWidget(self.ignore_case)
+        self.ignore_case.setChecked(self.prefs['ignore_case'])
+        if not self.use_file.isChecked():
+            self.ignore_case.setDisabled(True)
+
+        self.scan_quotes = QCheckBox(_('Use the faster, character scanning quotes engine'), self)
+        layout.addWidget(self.scan_quotes)
+        self.scan_quotes.setChecked(self.prefs['scan_quotes'])
+        if not self.edu_quotes.isChecked():
+            self.scan_quotes.setDisabled(True)
 
         combo_layout = QVBoxLayout()
         layout.addLayout(combo_layout)
@@ -323,6 +441,13 @@ class PunctDialog(Dialog):
         self.unicode = QCheckBox(_('Educate with unicode characters (instead of entities)'), self)
         layout.addWidget(self.unicode)
         self.unicode.setChecked(self.prefs['unicode'])
+        self.unicode.stateChanged.connect(self.unicode_gui_changes)
+
+        self.use_tree = QCheckBox(_('Work on the text of the parsed documents (unicode characters only)'), self)
+        layout.addWidget(self.use_tree)
+        self.use_tree.setChecked(self.prefs['use_tree'])
+        if not self.unicode.isChecked():
+            self.use_tree.setDisabled(True)
 
         layout.addSpacing(10)
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
@@ -373,14 +498,23 @@ class PunctDialog(Dialog):
         apos_words_list = []
         if apos_exception_file is not None:
             apos_words_list = self.parseExceptionsFile(os.path.normpath(apos_exception_file))
-        self.criteria = (smarty_attr, self.unicode.isChecked(), apos_words_list)
+        self.criteria = (smarty_attr, self.unicode.isChecked(), apos_words_list, self.ignore_case.isChecked(),
+                         self.scan_quotes.isChecked())
         self.savePrefs()
         self.accept()
 
     def getCriteria(self):
         return self.criteria
 
+    # smarten the parsed (lxml) trees of the files rather than their markup
+    def useTree(self):
+        return self.use_tree.isChecked() and self.unicode.isChecked()
+
+    def unicode_gui_changes(self):
+        self.use_tree.setDisabled(not self.unicode.isChecked())
+
     def quotes_gui_changes(self):
+        self.scan_quotes.setDisabled(not self.edu_quotes.isChecked())
         if self.edu_quotes.isChecked():
             self.use_file.setDisabled(False)
             if self.use_file.isChecked():
@@ -392,15 +526,18 @@ class PunctDialog(Dialog):
             self.file_path.setReadOnly(True)
             self.use_file.setDisabled(True)
             self.file_button.setDisabled(True)
+            self.ignore_case.setDisabled(True)
 
     def use_file_gui_changes(self):
         if self.use_file.isChecked():
             self.file_button.setDisabled(False)
+            self.ignore_case.setDisabled(False)
         else:
             self.file_path.setReadOnly(False)
             self.file_path.clear()
             self.file_path.setReadOnly(True)
             self.file_button.setDisabled(True)
+            self.ignore_case.setDisabled(True)
 
     def prefsPrep(self):
         from calibre.utils.config import JSONConfig
@@ -408,18 +545,24 @@ class PunctDialog(Dialog):
         plugin_prefs.defaults['edu_quotes'] = True
         plugin_prefs.defaults['use_file'] = False
         plugin_prefs.defaults['file_path'] = ''
+        plugin_prefs.defaults['ignore_case'] = False
+        plugin_prefs.defaults['scan_quotes'] = False
         plugin_prefs.defaults['dashes'] = 1
         plugin_prefs.defaults['ellipses'] = True
         plugin_prefs.defaults['unicode'] = True
+        plugin_prefs.defaults['use_tree'] = False
         return plugin_prefs
 
     def savePrefs(self):
         self.prefs['edu_quotes'] = self.edu_quotes.isChecked()
         self.prefs['use_file'] = self.use_file.isChecked()
         self.prefs['file_path'] = text_type(self.file_path.displayText()) if len(self.file_path.displayText()) else ''
+        self.prefs['ignore_case'] = self.ignore_case.isChecked()
+        self.prefs['scan_quotes'] = self.scan_quotes.isChecked()
         self.prefs['dashes'] = self.dashes_combo.currentIndex()
         self.prefs['ellipses'] = self.ellipses.isChecked()
         self.prefs['unicode'] = self.unicode.isChecked()
+        self.prefs['use_tree'] = self.use_tree.isChecked()
 
     def help_link_activated(self, url):
         def get_help_file_resource():
@@ -433,75 +576,264 @@ class PunctDialog(Dialog):
         open_url(QUrl(url))
 
     def parseExceptionsFile(self, filename):
-        import os, codecs, chardet
-        words_list = []
+        return load_exceptions_file(filename)
+
+
+# Decoded apostrophe exception files, keyed by (path, mtime, size) so that an
+# edited file is read again. Kept in memory and next to the plugin prefs, so
+# only the first run after the file changes has to read and decode it.
+_exceptions_cache = {}
+EXCEPTIONS_CACHE_SIZE = 8
+
+def load_exceptions_file(filename):
+    from calibre.utils.config import JSONConfig
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return []
+    key = (filename, st.st_mtime, st.st_size)
+    if key in _exceptions_cache:
+        return list(_exceptions_cache[key])
+
+    # everything lives under the one key: {path: {mtime, size, words, used}}
+    stored = JSONConfig('plugins/{0}_SmarterPunct_exceptions'.format(PLUGIN_SAFE_NAME))
+    cache = dict(stored.get('cache', {}))
+    entry = cache.get(filename)
+    if entry is not None and entry.get('mtime') == st.st_mtime and entry.get('size') == st.st_size:
+        words_list = entry['words']
+    else:
+        words_list = parse_exceptions_file(filename)
+        if words_list is None:
+            # couldn't be read or decoded, try again next time
+            return []
+        entry = {'mtime': st.st_mtime, 'size': st.st_size, 'words': words_list}
+    entry['used'] = time.time()
+    cache[filename] = entry
+    # forget the files used least recently
+    for old in sorted(cache, key=lambda k: cache[k].get('used', 0))[:-EXCEPTIONS_CACHE_SIZE]:
+        del cache[old]
+    stored['cache'] = cache
+    if len(_exceptions_cache) >= EXCEPTIONS_CACHE_SIZE:
+        _exceptions_cache.clear()
+    _exceptions_cache[key] = tuple(words_list)
+    return list(words_list)
+
+# The words of an exceptions file, or None when it can't be read
+def parse_exceptions_file(filename):
+    import codecs, chardet
+    try:
         bytes = min(32, os.path.getsize(filename))
-        raw = open(filename, 'rb').read(bytes)
+        with open(filename, 'rb') as f:
+            raw = f.read(bytes)
         if raw.startswith(codecs.BOM_UTF8):
             enc = 'utf-8-sig'
         else:
-            result = chardet.detect(raw)
-            enc = result['encoding']
+            enc = chardet.detect(raw)['encoding'] or 'utf-8'
+        with codecs.open(filename, encoding=enc, mode='r') as fd:
+            words_list = [line.rstrip() for line in fd]
+    except Exception:
+        return None
+    # a list, not a filter, so every file of the book gets all of it
+    return [word for word in words_list if word]
+
+
+class Cancelled(Exception):
+    pass
+
+# The callback can hand back (htmlstr, details) to have something about
+# each file passed on to the results.
+def split_result(result):
+    if isinstance(result, tuple):
+        return result
+    return result, None
+
+# Reads each file of a list and runs the callback over it away from the GUI
+# thread, handing the new text of the files it changed (None for the rest)
+# back through a signal. Only the one file being worked on is held at a time.
+class FileWorker(QThread):
+    file_done = pyqtSignal(object, object, object)
+
+    def __init__(self, names, read_fn, callback_fn, criteria, parent=None, parsed=False, fallback_fn=None,
+                 read_text_fn=None):
+        QThread.__init__(self, parent)
+        self.names, self.read_fn, self.callback_fn, self.criteria = names, read_fn, callback_fn, criteria
+        self.parsed = parsed
+        self.fallback_fn, self.read_text_fn = fallback_fn, read_text_fn
+        self.cancel_event = threading.Event()
+        self.error = None
+
+    # passed to the callback, which calls it as it goes so a cancel
+    # doesn't have to wait for the file to be finished
+    def checkpoint(self):
+        if self.cancel_event.is_set():
+            raise Cancelled()
+
+    def run(self):
         try:
-            with codecs.open(filename, encoding=enc, mode='r') as fd:
-                words_list = [line.rstrip() for line in fd]
-            words_list = filter(None, words_list)
-            print('Exceptions list:', words_list)
-        except Exception:
+            for name in self.names:
+                self.checkpoint()
+                data = self.read_fn(name)
+                if data is None:
+                    continue
+                htmlstr, details = self.do_file(name, data)
+                self.file_done.emit(name, htmlstr, details)
+        except Cancelled:
             pass
-        return words_list
-
+        except Exception:
+            import traceback
+            self.error = traceback.format_exc()
+
+    # the file's new text (or its changed tree), or None when it is unchanged, and the details
+    def do_file(self, name, data):
+        callback_fn = self.callback_fn
+        if self.parsed and not isinstance(data, text_type):
+            try:
+                changed, details = split_result(callback_fn(data, self.criteria, checkpoint=self.checkpoint))
+                # the tree was changed in place, and the result is whether it was
+                return (data if changed else None), details
+            except TreeUnsupported:
+                if self.fallback_fn is None:
+                    raise
+            # the tree can't be given the change, so the file's text is changed instead
+            data = self.read_text_fn(name)
+        if self.parsed:
+            callback_fn = self.fallback_fn
+        htmlstr, details = split_result(callback_fn(data, self.criteria, checkpoint=self.checkpoint))
+        return (None if htmlstr == data else htmlstr), details
+
+    def cancel(self):
+        self.cancel_event.set()
 
 class ShowProgressDialog(QProgressDialog):
-    def __init__(self, gui, container, match_list, criteria, callback_fn, action_type='Checking'):
+    # how often (ms) the label and progress bar are brought up to date
+    REFRESH_INTERVAL = 100
+
+    def __init__(self, gui, container, match_list, criteria, callback_fn, action_type='Checking', prefilter_fn=None,
+                 parsed=False, fallback_fn=None, names=None):
         self.file_list = [i[0] for i in container.mime_map.items() if i[1] in match_list]
+        self.total_count = len(self.file_list)
+        self.skipped = 0
+        # When the caller already knows which files can be changed (names),
+        # the rest are skipped without even being read
+        if names is not None:
+            self.file_list = [name for name in self.file_list if name in names]
+            self.skipped = self.total_count - len(self.file_list)
         self.clean = True
         self.changed_files = []
-        self.total_count = len(self.file_list)
+        self.details = {}
+        # the details of every file looked at, changed or not
+        self.file_details = {}
+        # An optional prefilter_fn(raw_bytes, criteria) is given each file before
+        # it is decoded and parsed, and can return False to skip it.
+        self.prefilter_fn = prefilter_fn
+        # With parsed, the callback is given the file's parsed tree to change
+        # in place instead, and returns (changed, details). The files it
+        # changes are marked dirty. An optional fallback_fn, a callback as
+        # for the text, is used on the files calibre can't parse and the
+        # trees the callback raises TreeUnsupported for.
+        self.parsed = parsed
+        self.fallback_fn = fallback_fn
+        # how many files fallback_fn changed
+        self.text_changed = 0
         QProgressDialog.__init__(self, '', _('Cancel'), 0, self.total_count, gui)
         self.setMinimumWidth(500)
         self.container, self.criteria, self.callback_fn, self.action_type = container, criteria, callback_fn, action_type
         self.gui = gui
         self.setWindowTitle('{0}...'.format(self.action_type))
         self.i = 0
-        QTimer.singleShot(0, self.do_action)
+        self.current_name = ''
+        self.error = None
+        self.closed = False
+        # The callback is a function taking (data, criteria, checkpoint=None).
+        # It runs, along with reading the files, on a worker thread. Only
+        # writing the changed files back happens on the GUI thread.
+        self.worker = None
+        # Progress is shown at a steady rate however quickly files get done
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start(self.REFRESH_INTERVAL)
+        QTimer.singleShot(0, self.do_start)
         self.exec_()
-
-    def do_action(self):
-        if self.wasCanceled():
-            return self.do_close()
-        if self.i >= self.total_count:
-            return self.do_close()
-        name = self.file_list[self.i]
-        data = self.container.raw_data(name)
-        # if is_py3:
-        #    data = bytes(data.encode('utf-8'))
-        # orig_hash = md5(data).digest()
-        self.i += 1
-
-        self.setLabelText('{0}: {1}'.format(self.action_type, name))
-        # Send the necessary data to the callback function in main.py.
-        print('Processing {0}'.format(name))
-        htmlstr = self.callback_fn(data, self.criteria)
-        # new_hash = md5(htmlstr).digest()
-        # if new_hash != orig_hash:
-        if htmlstr != data:
-            self.container.open(name, 'w').write(htmlstr)
+        if self.worker is not None:
+            # a cancel closes the dialog straight away, the worker stops at its next checkpoint
+            self.worker.wait()
+            self.error = self.worker.error
+        self.closed = True
+        if self.error is not None:
+            raise Exception(self.error)
+
+    # the text (or tree) of a file, or None when the prefilter rules it out
+    def read_file(self, name):
+        # Not for a file calibre already holds parsed: reading its bytes would
+        # write out and drop the tree (from this thread, too)
+        if self.prefilter_fn is not None and not (self.parsed and name in self.container.parsed_cache):
+            raw = self.container.raw_data(name, decode=False)
+            if not self.prefilter_fn(raw, self.criteria):
+                self.skipped += 1
+                return None
+            if not self.parsed:
+                return self.container.decode(raw)
+        if self.parsed:
+            try:
+                return self.container.parsed(name)
+            except Exception:
+                if self.fallback_fn is None:
+                    raise
+        return self.container.raw_data(name)
+
+    # htmlstr is the file's new text (or changed tree), or None when it is unchanged
+    def store_result(self, name, htmlstr, details):
+        if htmlstr is not None and not isinstance(htmlstr, text_type):
+            # The tree has been changed in place already, so it is marked
+            # dirty even when the run was cancelled, to be saved with the rest
+            self.container.dirty(name)
+        if self.closed:
+            # a file finished after the run was cancelled
+            return
+        if details is not None:
+            self.file_details[name] = details
+        if htmlstr is not None:
+            if isinstance(htmlstr, text_type):
+                self.container.open(name, 'w').write(htmlstr)
+                if self.parsed:
+                    self.text_changed += 1
             self.changed_files.append(name)
+            if details:
+                self.details[name] = details
             self.clean = False
+        self.i += 1
+        self.current_name = name
+
+    def refresh(self):
+        if self.current_name:
+            self.setLabelText('{0}: {1}'.format(self.action_type, self.current_name))
+        self.setValue(self.i + self.skipped)
 
-        self.setValue(self.i)
+    def do_start(self):
+        self.worker = FileWorker(self.file_list, self.read_file, self.callback_fn, self.criteria, self, self.parsed,
+                                 self.fallback_fn, self.container.raw_data)
+        self.worker.file_done.connect(self.store_result)
+        self.worker.finished.connect(self.worker_finished)
+        self.canceled.connect(self.worker.cancel)
+        self.worker.start()
 
-        # Lather, rinse, repeat
-        QTimer.singleShot(0, self.do_action)
+    def worker_finished(self):
+        self.do_close()
 
     def do_close(self):
+        if self.closed:
+            return
+        self.refresh_timer.stop()
+        self.refresh()
         self.hide()
         self.gui = None
 
 class ResultsDialog(Dialog):
-    def __init__(self, parent, files):
+    def __init__(self, parent, files, ranges=None, skipped=0, summary=None):
         self.files = files
+        self.ranges = ranges or {}
+        self.skipped = skipped
+        self.summary = summary
         Dialog.__init__(self, _('Changed Files'), 'toolbag_show_results_dialog', parent)
 
     def setup_ui(self):
@@ -516,6 +848,19 @@ class ResultsDialog(Dialog):
         # self.listy.setSelectionMode(QAbstractItemView.ExtendedSelection)
         main_layout.addWidget(self.listy)
         self.listy.addItems(self.files)
+        # Show the changed offsets of each file (as (start, end) ranges
+        # of its original text) when hovering over it.
+        for i, name in enumerate(self.files):
+            ranges = self.ranges.get(name)
+            if ranges:
+                shown = ', '.join('{0}-{1}'.format(start, end) for start, end in ranges[:50])
+                if len(ranges) > 50:
+                    shown += ', ...'
+                self.listy.item(i).setToolTip('<p>{0}: {1}'.format(_('Changed offsets'), shown))
+        if self.skipped:
+            layout.addWidget(QLabel(_('{0} file(s) skipped without parsing').format(self.skipped)))
+        if self.summary:
+            layout.addWidget(QLabel(self.summary))
 
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         button_box = QDialogButtonBox()
@@ -526,6 +871,33 @@ class ResultsDialog(Dialog):
         button_box.rejected.connect(self.reject)
         layout.addWidget(button_box)
 
+class CountsDialog(Dialog):
+    def __init__(self, parent, counts):
+        # counts is a list of (name, [(start, end), ...]) for the files with matches
+        self.counts = counts
+        Dialog.__init__(self, _('Matches Found'), 'toolbag_show_counts_dialog', parent)
+
+    def setup_ui(self):
+        self.setMinimumWidth(300)
+        self.setMinimumHeight(300)
+        layout = QVBoxLayout(self)
+        self.setLayout(layout)
+
+        total = sum(len(offsets) for name, offsets in self.counts)
+        layout.addWidget(QLabel(_('{0} match(es) in {1} file(s)').format(total, len(self.counts))))
+        self.listy = QListWidget()
+        layout.addWidget(self.listy)
+        for i, (name, offsets) in enumerate(self.counts):
+            self.listy.addItem('{0} ({1})'.format(name, len(offsets)))
+            shown = ', '.join('{0}-{1}'.format(start, end) for start, end in offsets[:50])
+            if len(offsets) > 50:
+                shown += ', ...'
+            self.listy.item(i).setToolTip('<p>{0}: {1}'.format(_('Match offsets'), shown))
+
+        button_box = QDialogButtonBox(QDialogButtonBox.Close)
+        button_box.rejected.connect(self.reject)
+        layout.addWidget(button_box)
+
 def load_resource(name):
     with ZipFile(PLUGIN_PATH, 'r') as zf:
         if name in zf.namelist():
@@ -18,14 +18,15 @@ import os
 
 from calibre.gui2.tweak_book.plugin import Tool
 from calibre.gui2.tweak_book import editor_name
-from calibre.gui2 import error_dialog, info_dialog
+from calibre.gui2 import error_dialog, info_dialog, choose_files
 from calibre.ebooks.oeb.polish.container import OEB_DOCS, OEB_STYLES
 
 from calibre.utils.config import JSONConfig, config_dir
-from calibre_plugins.diaps_toolbag.resources.html_parser import MarkupParser
-from calibre_plugins.diaps_toolbag.resources.smartypants import smartyPants
-from calibre_plugins.diaps_toolbag.utilities import unescape
+from calibre_plugins.diaps_toolbag.resources.html_parser import MarkupParser, CompiledCriteria, load_rules
+from calibre_plugins.diaps_toolbag.tasks import (delete_modify, delete_modify_tree, TreeUnsupported, smarten,
+                                                 smarten_tree)
 from calibre_plugins.diaps_toolbag.dialogs import ResultsDialog
+from calibre_plugins.diaps_toolbag.tag_index import get_index
 
 from calibre_plugins.diaps_toolbag.__init__ import PLUGIN_SAFE_NAME
 
@@ -62,6 +63,7 @@ class SpanDivEdit(Tool):
     def create_action(self, for_toolbar=True):
         self.plugin_prefs = JSONConfig('plugins/{0}_SpanDivEdit'.format(PLUGIN_SAFE_NAME))
         self.plugin_prefs.defaults['parse_current'] = True
+        self.plugin_prefs.defaults['use_tree'] = False
 
         # Create an action, this will be added to the plugins toolbar and
         # the plugins menu
@@ -78,7 +80,11 @@ class SpanDivEdit(Tool):
             checked_menu_item = menu.addAction(_('Edit current file only'), self.toggle_parse_current)
             checked_menu_item.setCheckable(True)
             checked_menu_item.setChecked(self.parse_current)
+            tree_menu_item = menu.addAction(_('Edit the parsed documents'), self.toggle_use_tree)
+            tree_menu_item.setCheckable(True)
+            tree_menu_item.setChecked(self.use_tree)
             menu.addSeparator()
+            menu.addAction(_('Run saved preset...'), self.run_preset)
             menu.addAction(_('Customize'), self.show_configuration)
         ac.triggered.connect(self.dispatcher)
         return ac
@@ -87,75 +93,217 @@ class SpanDivEdit(Tool):
         self.parse_current = not self.parse_current
         self.save_prefs()
 
-    def dispatcher(self):
+    def toggle_use_tree(self):
+        self.use_tree = not self.use_tree
+        self.save_prefs()
+
+    def can_process(self):
         container = self.current_container  # The book being edited as a container object
         if not container:
-            return info_dialog(self.gui, _('No book open'),
+            info_dialog(self.gui, _('No book open'),
                         _('Need to have a book open first.'), show=True)
+            return False
         if self.parse_current:
             name = editor_name(self.gui.central.current_editor)
             if not name or container.mime_map[name] not in OEB_DOCS:
-                return info_dialog(self.gui, _('Cannot Process'),
+                info_dialog(self.gui, _('Cannot Process'),
                         _('No file open for editing or the current file is not an (x)html file.'), show=True)
+                return False
+        return True
 
-        self.cleanasawhistle = True
-        self.changed_files = []
+    def dispatcher(self):
+        if not self.can_process():
+            return
 
         from calibre_plugins.diaps_toolbag.dialogs import RemoveDialog
-        dlg = RemoveDialog(self.gui)
-        if dlg.exec_():
-            criteria = dlg.getCriteria()
+        # The book's tag index is brought up to date while the dialog is open,
+        # and stopped before anything is changed
+        self.boss.commit_all_editors_to_container()
+        index = get_index(self.current_container)
+        index.start()
+        dlg = RemoveDialog(self.gui, index)
+        accepted = dlg.exec_()
+        index.cancel()
+        if accepted:
+            # Work out everything about the criteria once and share it with every file
+            try:
+                plan = CompiledCriteria(*dlg.getCriteria())
+            except Exception as e:
+                # most likely a regex that doesn't compile
+                return error_dialog(self.gui, _('Failed'),
+                        _('Could not use the search criteria, click "Show details" for more info'),
+                        det_msg=str(e), show=True)
+            if dlg.isCountOnly():
+                self.count_plan(plan)
+            else:
+                self.run_plan(plan)
 
-            # Ensure any in progress editing the user is doing is present in the container
-            self.boss.commit_all_editors_to_container()
-            self.boss.add_savepoint(_('Before: Span Div Edit'))
+    def run_preset(self):
+        if not self.can_process():
+            return
 
-            try:
-                self.process_files(criteria)
-            except Exception:
-                # Something bad happened report the error to the user
-                import traceback
-                error_dialog(self.gui, _('Failed'),
-                    _('Failed to process divs or spans, click "Show details" for more info'),
-                    det_msg=traceback.format_exc(), show=True)
-                # Revert to the saved restore point
-                self.boss.revert_requested(self.boss.global_undo.previous_container)
+        files = choose_files(self.gui, 'toolbag_spandiv_preset', _('Select a saved preset'),
+                             filters=[(_('Presets'), ['json'])], all_files=False, select_only_single_file=True)
+        if not files:
+            return
+        from calibre_plugins.diaps_toolbag.span_div_config import plugin_prefs
+        try:
+            # A preset is a JSON list of rules, all applied in a single pass over each file
+            plan = load_rules(files[0], verbatim=plugin_prefs['verbatim'])
+        except Exception as e:
+            return error_dialog(self.gui, _('Invalid preset'),
+                    _('Could not load the preset file: {0}').format(files[0]),
+                    det_msg=str(e), show=True)
+        self.run_plan(plan)
+
+    def run_plan(self, plan):
+        self.cleanasawhistle = True
+        self.changed_files = []
+        self.changed_ranges = {}
+        self.skipped = 0
+        # with use_tree, how many elements were changed in the parsed documents,
+        # and how many files had to be changed on their text instead
+        self.tree_changed = 0
+        self.text_changed = 0
+
+        # Ensure any in progress editing the user is doing is present in the container
+        self.boss.commit_all_editors_to_container()
+        self.boss.add_savepoint(_('Before: Span Div Edit'))
+
+        try:
+            self.process_files(plan)
+            get_index(self.current_container).invalidate(self.changed_files)
+        except Exception:
+            # Something bad happened report the error to the user
+            import traceback
+            error_dialog(self.gui, _('Failed'),
+                _('Failed to process divs or spans, click "Show details" for more info'),
+                det_msg=traceback.format_exc(), show=True)
+            # Revert to the saved restore point
+            self.boss.revert_requested(self.boss.global_undo.previous_container)
+        else:
+            if not self.cleanasawhistle:
+                # Show the user what changes we have made,
+                # allowing then to revert them if necessary
+                accepted = ResultsDialog(self.gui, self.changed_files, self.changed_ranges, self.skipped,
+                                         self.tree_summary()).exec_()
+                if accepted == QDialog.Accepted:
+                    self.boss.show_current_diff()
+                # Update the editor UI to take into account all the changes we
+                # have made
+                self.boss.apply_container_update_to_gui()
             else:
-                if not self.cleanasawhistle:
-                    # Show the user what changes we have made,
-                    # allowing then to revert them if necessary
-                    accepted = ResultsDialog(self.gui, self.changed_files).exec_()
-                    if accepted == QDialog.Accepted:
-                        self.boss.show_current_diff()
-                    # Update the editor UI to take into account all the changes we
-                    # have made
-                    self.boss.apply_container_update_to_gui()
-                else:
-                    info_dialog(self.gui, _('Nothing changed'),
-                    '<p>{0}'.format(_('Nothing matching your criteria was found.')), show=True)
+                msg = '<p>{0}'.format(_('Nothing matching your criteria was found.'))
+                if self.skipped:
+                    msg += '<p>{0}'.format(_('{0} file(s) skipped without parsing').format(self.skipped))
+                info_dialog(self.gui, _('Nothing changed'), msg, show=True)
+
+    def tree_summary(self):
+        if not self.use_tree:
+            return None
+        summary = _('{0} tag(s) removed or changed in the parsed documents').format(self.tree_changed)
+        if self.text_changed:
+            summary += '\n' + _('{0} file(s) changed on their text, as their parsed documents could not be').format(
+                self.text_changed)
+        return summary
+
+    def count_plan(self, plan):
+        container = self.current_container  # The book being edited as a container object
+        # Counting reads the editors' text but makes no savepoint and writes nothing back
+        self.boss.commit_all_editors_to_container()
+        if self.parse_current:
+            names = [editor_name(self.gui.central.current_editor)]
+        else:
+            candidates = get_index(container).candidates(plan)
+            names = [name for name, mt in container.mime_map.items() if mt in OEB_DOCS and name in candidates]
+
+        counts = []
+        try:
+            for name in names:
+                raw = container.raw_data(name, decode=False)
+                if not plan.could_contain(raw):
+                    continue
+                offsets = MarkupParser(container.decode(raw), criteria=plan).matches()
+                if offsets:
+                    counts.append((name, offsets))
+        except Exception:
+            import traceback
+            return error_dialog(self.gui, _('Failed'),
+                _('Failed to count divs or spans, click "Show details" for more info'),
+                det_msg=traceback.format_exc(), show=True)
+        if counts:
+            from calibre_plugins.diaps_toolbag.dialogs import CountsDialog
+            CountsDialog(self.gui, counts).exec_()
+        else:
+            info_dialog(self.gui, _('Nothing found'),
+                '<p>{0}'.format(_('Nothing matching your criteria was found.')), show=True)
 
     def process_files(self, criteria):
         container = self.current_container  # The book being edited as a container object
 
         if self.parse_current:
             name = editor_name(self.gui.central.current_editor)
+            if self.use_tree and self.process_tree(name, criteria):
+                return
             data = container.raw_data(name)
-            htmlstr = self.delete_modify(data, criteria)
-            if htmlstr != data:
+            htmlstr, ranges = delete_modify(data, criteria)
+            if ranges:
                 self.cleanasawhistle = False
+                self.changed_files.append(name)
+                self.changed_ranges[name] = ranges
+                self.text_changed += 1
                 container.open(name, 'w').write(htmlstr)
         else:
             from calibre_plugins.diaps_toolbag.dialogs import ShowProgressDialog
-            d = ShowProgressDialog(self.gui, container, OEB_DOCS, criteria, self.delete_modify, _('Parsing'))
+            # With use_tree the parsed documents are changed, and delete_modify is
+            # only used on the files that can't be done that way
+            d = ShowProgressDialog(self.gui, container, OEB_DOCS, criteria,
+                                   delete_modify_tree if self.use_tree else delete_modify, _('Parsing'),
+                                   prefilter_fn=self.might_match, parsed=self.use_tree,
+                                   fallback_fn=delete_modify, names=self.candidates(criteria))
             self.cleanasawhistle = d.clean
             self.changed_files.extend(d.changed_files)
+            for name, details in d.details.items():
+                # the number of elements changed in a tree, or the changed ranges of a text
+                if isinstance(details, list):
+                    self.changed_ranges[name] = details
+                else:
+                    self.tree_changed += details
+            self.text_changed = d.text_changed
+            self.skipped = d.skipped
 
-    def delete_modify(self, data, criteria):
-        _parser = MarkupParser(data, srch_str=criteria[0], srch_method=criteria[1], tag=criteria[2], attrib=criteria[3],
-                               action=criteria[4], new_tag=criteria[5], new_str=criteria[6], copy=criteria[7])
-
-        htmlstr = _parser.processml()
-        return htmlstr
+    # change the current file's parsed document, returning False when the
+    # file has to be changed on its text instead
+    def process_tree(self, name, criteria):
+        container = self.current_container
+        try:
+            root = container.parsed(name)
+        except Exception:
+            return False
+        try:
+            changed, count = delete_modify_tree(root, criteria)
+        except TreeUnsupported:
+            return False
+        if changed:
+            self.cleanasawhistle = False
+            self.changed_files.append(name)
+            self.tree_changed += count
+            container.dirty(name)
+        return True
+
+    # The files the book's tag index says could have a match, or None for all
+    # of them. Outside of verbatim mode every tag of every file is rewritten.
+    def candidates(self, criteria):
+        if not (criteria.verbatim or self.use_tree):
+            return None
+        return get_index(self.current_container).candidates(criteria)
+
+    def might_match(self, raw, criteria):
+        # Files that can't hold a matching tag are passed over without being decoded or parsed
+        if self.use_tree:
+            # only the matching elements of a parsed document are ever touched
+            return criteria.could_contain(raw)
+        return criteria.might_match(raw)
 
     def show_configuration(self):
         from calibre_plugins.diaps_toolbag.span_div_config import ConfigWidget
@@ -165,9 +313,11 @@ class SpanDivEdit(Tool):
 
     def restore_prefs(self):
         self.parse_current = self.plugin_prefs.get('parse_current')
+        self.use_tree = self.plugin_prefs.get('use_tree')
 
     def save_prefs(self):
         self.plugin_prefs['parse_current'] = self.parse_current
+        self.plugin_prefs['use_tree'] = self.use_tree
 
 
 class SmarterPunct(Tool):
@@ -217,6 +367,7 @@ class SmarterPunct(Tool):
 
         self.cleanasawhistle = True
         self.changed_files = []
+        self.stats = {'tokens': 0, 'skipped': 0, 'cached': 0}
 
         from calibre_plugins.diaps_toolbag.dialogs import PunctDialog
         dlg = PunctDialog(self.gui)
@@ -227,7 +378,7 @@ class SmarterPunct(Tool):
             self.boss.add_savepoint(_('Before: Smarten Punctuation'))
 
             try:
-                self.process_files(criteria)
+                self.process_files(criteria, dlg.useTree())
             except Exception:
                 # Something bad happened report the error to the user
                 import traceback
@@ -240,7 +391,7 @@ class SmarterPunct(Tool):
                 if not self.cleanasawhistle:
                     # Show the user what changes we have made,
                     # allowing then to revert them if necessary
-                    accepted = ResultsDialog(self.gui, self.changed_files).exec_()
+                    accepted = ResultsDialog(self.gui, self.changed_files, summary=self.stats_summary()).exec_()
                     if accepted == QDialog.Accepted:
                         self.boss.show_current_diff()
                     # Update the editor UI to take into account all the changes we
@@ -248,44 +399,51 @@ class SmarterPunct(Tool):
                     self.boss.apply_container_update_to_gui()
                 else:
                     info_dialog(self.gui, _('Nothing smartened'),
-                    '<p>{0}'.format(_('No punctuation meeting your criteria was found to smarten.')), show=True)
-
-    def process_files(self, criteria):
+                    '<p>{0}<p>{1}'.format(_('No punctuation meeting your criteria was found to smarten.'),
+                                          self.stats_summary()), show=True)
+
+    def stats_summary(self):
+        tokens, skipped = self.stats['tokens'], self.stats['skipped']
+        summary = _('{0} of {1} text runs had nothing to smarten ({2:.0%})').format(
+            skipped, tokens, skipped / tokens if tokens else 0)
+        if self.stats['cached']:
+            summary += _(', {0} were the same as ones smartened before').format(self.stats['cached'])
+        return summary
+
+    def add_stats(self, stats):
+        for key in self.stats:
+            self.stats[key] += stats.get(key, 0)
+
+    # use_tree works on the text of the parsed (lxml) trees calibre keeps of
+    # the files, rather than on their markup
+    def process_files(self, criteria, use_tree=False):
         container = self.current_container  # The book being edited as a container object
         if self.parse_current:
             name = editor_name(self.gui.central.current_editor)
-            data = container.raw_data(name)
-            htmlstr = self.smarten(data, criteria)
-            if htmlstr != data:
+            if use_tree:
+                changed, stats = smarten_tree(container.parsed(name), criteria)
+                if changed:
+                    container.dirty(name)
+            else:
+                data = container.raw_data(name)
+                htmlstr, stats = smarten(data, criteria)
+                changed = htmlstr != data
+                if changed:
+                    container.open(name, 'w').write(htmlstr)
+            self.add_stats(stats)
+            if changed:
                 self.cleanasawhistle = False
-                container.open(name, 'w').write(htmlstr)
         else:
             from calibre_plugins.diaps_toolbag.dialogs import ShowProgressDialog
-            d = ShowProgressDialog(self.gui, container, OEB_DOCS, criteria, self.smarten, _('Smartening'))
+            d = ShowProgressDialog(self.gui, container, OEB_DOCS, criteria, smarten_tree if use_tree else smarten,
+                                   _('Smartening'), parsed=use_tree)
             cancelled_msg = ''  # noqa
             if d.wasCanceled():
                 cancelled_msg = ' (cancelled)'  # noqa
             self.cleanasawhistle = d.clean
             self.changed_files.extend(d.changed_files)
-
-    def smarten(self, data, criteria):
-        from uuid import uuid4
-        AMPERSAND = 'ampersand-{0}'.format(str(uuid4()))
-        smarty_attr, use_unicode, apos_words_list = criteria[0], criteria[1], criteria[2]
-
-        # Slightly mangle all preexisting entities so HTMLParser
-        # ignores them. We'll put them all back at the end.
-        data = data.replace('&', AMPERSAND)
-
-        htmlstr = smartyPants(data, smarty_attr, AMPERSAND, apos_words_list)
-
-        #  Convert the entities we created to unicode characters
-        if use_unicode:
-            htmlstr = unescape(htmlstr)
-        # Unmangle the pre-existing entities
-        htmlstr = htmlstr.replace(AMPERSAND, '&')
-
-        return htmlstr
+            for stats in d.file_details.values():
+                self.add_stats(stats)
 
     def restore_prefs(self):
         self.parse_current = self.plugin_prefs.get('parse_current')
@@ -7,6 +7,7 @@ __license__   = 'GPL v3'
 __docformat__ = 'restructuredtext en'
 
 from collections import OrderedDict
+import re as sre
 import regex as re
 
 SVG_ATTR = ['attributeName', 'attributeType', 'baseFrequency', 'baseProfile', 'calcMode', 'clipPathUnits', 'contentScriptType', 'contentStyleType',
@@ -18,175 +19,370 @@ SVG_ATTR = ['attributeName', 'attributeType', 'baseFrequency', 'baseProfile', 'c
             'stitchTiles', 'surfaceScale', 'systemLanguage', 'tableValues', 'targetX','targetY', 'textLength', 'viewBox', 'viewTarget', 'xChannelSelector',
             'yChannelSelector', 'zoomAndPan']
 
+SVG_ATTR_SET = frozenset(SVG_ATTR)
+
+# Splits the markup into runs of text, comments and tags. A tag runs to the
+# first '>' unless another '<' turns up first, in which case the stray '<' is
+# passed along as text. PIs, the DOCTYPE and CDATA are caught as tags and told
+# apart by their names in parsetag.
+# The standard library engine is quicker than regex at these short matches.
+ML_SCANNER = sre.compile(r"""
+    (?P<text>[^<]+)
+  | (?P<comment>(?=<!--)<!.*?-->)
+  | (?P<tag><[^<>]*>)
+  | (?P<stray><[^<]*)
+""", sre.S | sre.X)
+
+# The opening of a tag: an optional end tag slash, then either the start of a
+# comment or the (possibly empty) tag name.
+TAG_HEAD = sre.compile(r"""< *(/ *)?(?:(!--)|([^>/ "'\r\n]*))""")
+
+# One name=value pair inside a tag. Values are either double quoted or run to
+# the next '>', '/' or space.
+TAG_ATTR = sre.compile(r"""[ \r\n]*([^=]*)=[ ]*(?:"([^"]*)"|([^>/ ]*))""")
+
+# Same as above for the user supplied attribute string, which only ever had
+# plain spaces skipped around its pairs.
+NEW_ATTR = sre.compile(r"""[ ]*([^=]*)=[ ]*(?:"([^"]*)"|([^>/ ]*))""")
+
 def attrMatch(attr_str, method, srch_str):
     if method == 'normal':
         return (attr_str == srch_str)
+    elif method == 'token':
+        return not frozenset(srch_str.split()).isdisjoint(attr_str.split())
     elif method == 'regex':
         if re.match(r"""%s""" % srch_str, attr_str, re.U) is not None:
             return True
         else:
             return False
 
-class MarkupParser(object):
-    def __init__(self, data, srch_str=None, srch_method='normal', tag='span', attrib='class', action='delete', new_tag=None,  new_str='', copy=False):
-        self.wipml = data
-        self.pos = 0
-        self.path = []
-        self.tag = tag
-        self.new_tag = new_tag
-        self.attrib = attrib
+def attr_name(aname):
+    if aname.strip() not in SVG_ATTR_SET:
+        aname = aname.lower()
+    return aname
+
+def parse_new_tattr(s, p=0):
+    tattr = {}
+    for aname, qval, val in NEW_ATTR.findall(s, p):
+        tattr[attr_name(aname).rstrip(' ')] = qval or val
+    return tattr
+
+# flags kept on the nesting path for tags that are being removed or changed
+REMOVE = 1
+CHANGE = 2
+
+BEGIN_TYPES = frozenset(('begin', 'single', 'single_ext'))
+
+# Everything MarkupParser needs to know about the user's criteria, worked out
+# once per run so the same plan can be shared by every file in the book.
+# Takes the same (positional) values as RemoveDialog.getCriteria.
+class CompiledCriteria(object):
+    def __init__(self, srch_str=None, srch_method='normal', tag='span', attrib='class', action='delete', new_tag=None,  new_str='', copy=False, verbatim=False,
+                 drop_tokens=False):
         self.srch_str = srch_str
         self.srch_method = srch_method
+        self.tag = tag
+        self.attrib = attrib
         self.action = action
+        self.new_tag = new_tag
         self.new_str = new_str
         self.copy_attr = copy
+        self.verbatim = verbatim
+        self.flag = REMOVE if action == 'delete' else CHANGE
+        # name a changed tag ends up with
+        self.out_tag = tag if new_tag is None else new_tag
+        # attributes a changed tag ends up with, unless it keeps its own
+        if attrib is not None and copy:
+            self.keep_tattr = True
+            self.new_tattr = None
+        else:
+            self.keep_tattr = False
+            self.new_tattr = parse_new_tattr(new_str) if len(new_str) else None
+        self.srch_re = None
+        if attrib is not None and srch_method == 'regex':
+            self.srch_re = re.compile(r"""%s""" % srch_str, re.U)
+        # With the 'token' method srch_str is one or more (space separated)
+        # tokens, and a value matches when any of its tokens is one of them,
+        # as with class="calibre5 italic" and "italic"
+        self.srch_tokens = None
+        if attrib is not None and srch_method == 'token':
+            self.srch_tokens = frozenset((srch_str or '').split())
+        # a changed tag can lose just the tokens matched, keeping the rest of its attributes
+        self.drop_tokens = bool(drop_tokens) and self.srch_tokens is not None
+        if self.drop_tokens:
+            self.keep_tattr = False
+            self.new_tattr = None
+        # cheap tests on a file's undecoded bytes, see could_contain
+        self.raw_tag_re = sre.compile(b'<[ ]*' + sre.escape(tag.encode('utf-8')), sre.I)
+        self.raw_values = ()
+        if attrib is not None and srch_str and srch_method in ('normal', 'token'):
+            try:
+                self.raw_values = tuple(value.encode('ascii') for value in
+                                        (self.srch_tokens if srch_method == 'token' else (srch_str,)))
+            except UnicodeError:
+                pass
+
+    # can a file whose undecoded bytes are raw contain a match at all.
+    # False is only ever returned when it certainly can't, so anything
+    # not in an ascii compatible encoding is let through.
+    def could_contain(self, raw):
+        if raw[:2] in (b'\xff\xfe', b'\xfe\xff') or b'\x00' in raw[:4]:
+            return True
+        if self.raw_tag_re.search(raw) is None:
+            return False
+        if not self.raw_values:
+            return True
+        for value in self.raw_values:
+            if value in raw:
+                return True
+        return False
+
+    # can parsing the file change it. Outside of verbatim mode every tag
+    # the parser touches is rewritten, matched or not.
+    def might_match(self, raw):
+        return not self.verbatim or self.could_contain(raw)
+
+    # does a begin (or single) tag's attribute dictionary match
+    def matches(self, tattr):
+        if self.attrib is None:
+            return not len(tattr)
+        val = tattr.get(self.attrib)
+        if val is None:
+            return False
+        if self.srch_re is not None:
+            return self.srch_re.match(val) is not None
+        if self.srch_tokens is not None:
+            return not self.srch_tokens.isdisjoint(val.split())
+        return val == self.srch_str
+
+    # a matched tag's attributes less the tokens matched, and less the
+    # attribute itself when it has none left
+    def without_tokens(self, tattr):
+        tattr = tattr.copy()
+        kept = [token for token in tattr[self.attrib].split() if token not in self.srch_tokens]
+        if kept:
+            tattr[self.attrib] = ' '.join(kept)
+        else:
+            del tattr[self.attrib]
+        return tattr
+
+# An ordered list of CompiledCriteria applied together in a single pass.
+# Each rule sees a tag as the rules before it left it, so the result is the
+# same as running the rules one after the other. Rules are looked up
+# through an index keyed by (tag, attribute), so tags no rule is
+# interested in cost a single set lookup.
+class RuleSet(object):
+    def __init__(self, rules, verbatim=None):
+        self.rules = list(rules)
+        if verbatim is None:
+            verbatim = bool(self.rules) and self.rules[0].verbatim
+        self.verbatim = verbatim
+        self.index = {}
+        for order, rule in enumerate(self.rules):
+            self.index.setdefault((rule.tag, rule.attrib), []).append((order, rule))
+        self.tags = frozenset(rule.tag for rule in self.rules)
+        self.attribs = {}
+        for tag, attrib in self.index:
+            self.attribs.setdefault(tag, []).append(attrib)
+
+    # any rule that can still fire lets the file through, since rules
+    # later in the chain can only match what is in the file or what an
+    # earlier rule made
+    def could_contain(self, raw):
+        for rule in self.rules:
+            if rule.could_contain(raw):
+                return True
+        return False
+
+    def might_match(self, raw):
+        return not self.verbatim or self.could_contain(raw)
+
+    # rules that could apply to a begin tag, in order
+    def candidates(self, tname, tattr):
+        found = []
+        for attrib in self.attribs[tname]:
+            if attrib is None:
+                if not len(tattr):
+                    found.extend(self.index[(tname, None)])
+            elif attrib in tattr:
+                found.extend(self.index[(tname, attrib)])
+        if len(found) > 1:
+            found.sort(key=lambda x: x[0])
+        return found
+
+    # run a begin tag through the rules, returning its flag
+    # and the name and attributes it ends up with
+    def apply(self, tname, tattr):
+        flag = 0
+        after = -1
+        while tname in self.tags:
+            for order, rule in self.candidates(tname, tattr):
+                if order > after and rule.matches(tattr):
+                    break
+            else:
+                break
+            if rule.flag == REMOVE:
+                return REMOVE, tname, None
+            flag = CHANGE
+            after = order
+            tname = rule.out_tag
+            if rule.drop_tokens:
+                tattr = rule.without_tokens(tattr)
+            elif not rule.keep_tattr:
+                tattr = rule.new_tattr if rule.new_tattr is not None else {}
+        return flag, tname, tattr
+
+    # An XPath expression, and the values of its variables, selecting the
+    # elements of a parsed document that some rule matches as they are.
+    # Names are matched whatever their namespace. Values are passed as
+    # variables so they need no quoting. Regex values are only tested for
+    # being there, apply() has the last word on every element selected.
+    def xpath(self):
+        tests = []
+        variables = {}
+        for i, rule in enumerate(self.rules):
+            variables['t%d' % i] = rule.tag
+            test = 'local-name()=$t%d' % i
+            if rule.attrib is None:
+                test += ' and not(@*)'
+            else:
+                variables['a%d' % i] = rule.attrib
+                if rule.srch_tokens is not None:
+                    # a value holding a token holds it as a substring too
+                    found = []
+                    for j, token in enumerate(sorted(rule.srch_tokens)):
+                        variables['v%d_%d' % (i, j)] = token
+                        found.append('contains(., $v%d_%d)' % (i, j))
+                    test += ' and @*[name()=$a%d and (%s)]' % (i, ' or '.join(found) or 'false()')
+                elif rule.srch_re is None:
+                    variables['v%d' % i] = rule.srch_str or ''
+                    test += ' and @*[name()=$a%d and .=$v%d]' % (i, i)
+                else:
+                    test += ' and @*[name()=$a%d]' % i
+            tests.append('(%s)' % test)
+        return '//*[%s]' % (' or '.join(tests) or 'false()'), variables
+
+# Build a RuleSet from a saved JSON preset: a list of objects using the
+# CompiledCriteria argument names, e.g.
+# [{"tag": "span", "attrib": "class", "srch_str": "calibre12", "action": "delete"},
+#  {"tag": "div", "attrib": "class", "srch_str": "para", "action": "modify", "new_tag": "p"}]
+def load_rules(filename, verbatim=False):
+    import json
+    with open(filename, 'rb') as f:
+        entries = json.loads(f.read().decode('utf-8'))
+    if not isinstance(entries, list):
+        raise ValueError('A span/div preset must be a list of rules')
+    rules = []
+    for entry in entries:
+        # names are compared the way the parser reads them from the markup
+        for key in ('tag', 'new_tag'):
+            if entry.get(key) is not None:
+                entry[key] = entry[key].lower()
+        if entry.get('attrib') is not None:
+            entry['attrib'] = attr_name(entry['attrib']).strip()
+        rules.append(CompiledCriteria(**entry))
+    return RuleSet(rules, verbatim=verbatim)
+
+# rebuild data from a sequence of (start, end, replacement) edits
+# sorted by start offset, in a single pass
+def iter_apply_edits(data, edits):
+    copied = 0
+    for start, end, repl in edits:
+        if start > copied:
+            yield data[copied:start]
+        if repl:
+            yield repl
+        copied = end
+    if copied < len(data):
+        yield data[copied:]
+
+def apply_edits(data, edits):
+    return ''.join(iter_apply_edits(data, edits))
+
+class MarkupParser(object):
+    def __init__(self, data, srch_str=None, srch_method='normal', tag='span', attrib='class', action='delete', new_tag=None,  new_str='', copy=False, verbatim=False,
+                 criteria=None, checkpoint=None, drop_tokens=False):
+        self.wipml = data
+        # called once per tag, it can raise to abandon the parse part way through
+        self.checkpoint = checkpoint
+        self.pos = 0
+        self.path = []
+        # a CompiledCriteria (or a RuleSet of them) built once for the
+        # whole run can be passed in place of the individual values
+        if criteria is None:
+            criteria = CompiledCriteria(srch_str, srch_method, tag, attrib, action, new_tag, new_str, copy, verbatim,
+                                        drop_tokens)
+        if not isinstance(criteria, RuleSet):
+            criteria = RuleSet([criteria])
+        self.criteria = criteria
 
     def parse_new_tattr(self, s, p=0):
-        tattr = {}
-        while s.find('=',p) != -1 :
-            while s[p:p+1] == ' ' : p += 1
-            b = p
-            while s[p:p+1] != '=' : p += 1
-            aname = s[b:p]
-            if aname.strip() not in SVG_ATTR:
-                aname = aname.lower()
-            aname = aname.rstrip(' ')
-            p += 1
-            while s[p:p+1] == ' ' : p += 1
-            if s[p:p+1] == '"' :
-                p = p + 1
-                b = p
-                while s[p:p+1] != '"': p += 1
-                val = s[b:p]
-                p += 1
-            else :
-                b = p
-                while s[p:p+1] not in ('>', '/', ' ') : p += 1
-                val = s[b:p]
-            tattr[aname] = val
-        return tattr
+        return parse_new_tattr(s, p)
 
     # parse leading text of xhtml and tag
     def parseml(self):
-        p = self.pos
-        if p >= len(self.wipml):
+        m = ML_SCANNER.match(self.wipml, self.pos)
+        if m is None:
             return None
-        if self.wipml[p] != '<':
-            res = self.wipml.find('<',p)
-            if res == -1 :
-                res = len(self.wipml)
-            self.pos = res
-            return self.wipml[p:res], None
-        # handle comment as a special case
-        # deal with even multipline comments properly
-        # don't parse code in in between
-        if self.wipml[p:p+4] == '<!--':
-            te = self.wipml.find('-->',p+1)
-            if te != -1:
-                te = te+2
-        else :
-            tb = p
-            te = self.wipml.find('>',p+1)
-            ntb = self.wipml.find('<',p+1)
-            if ntb != -1 and ntb < te:
-                self.pos = ntb
-                return self.wipml[p:ntb], None
-        self.pos = te + 1
-        return None, self.wipml[p:te+1]
+        self.pos = m.end()
+        if m.lastgroup in ('comment', 'tag'):
+            return None, m.group()
+        return m.group(), None
+
+    # same as repeated calls to parseml, but in a single scan of the markup
+    def iterml(self):
+        for m in ML_SCANNER.finditer(self.wipml, self.pos):
+            self.pos = m.end()
+            if m.lastgroup in ('comment', 'tag'):
+                yield None, m.group()
+            else:
+                yield m.group(), None
 
     # parses string version of tag to identify its name,
     # its type 'begin', 'end' or ('single'|'single_ext'),
     # plus build a hashtable of its atributes
     # code is written to handle the possiblity of very poor formating
     def parsetag(self, s):
-        p = 1
-        # get the tag name
-        tname = None
         ttype = None
         tattr = None
-        while s[p:p+1] == ' ' : p += 1
-        if s[p:p+1] == '/':
+        m = TAG_HEAD.match(s)
+        end, comment, tname = m.groups()
+        # handle comment special case as there may be no spaces to
+        # delimit name begin or end
+        if comment is not None:
+            return 'passthru', '!--', {'info': s[m.end():-3].strip()}
+        p = m.end()
+        tname = tname.lower()
+        if end is not None:
             ttype = 'end'
-            p += 1
-            while s[p:p+1] == ' ' : p += 1
-        b = p
-        # handle comment special case as there may be no spaces to 
-        # delimit name begin or end 
-        if s[b:].startswith('!--'):
-            p = b+3
-            tname = '!--'
-            ttype = 'passthru'
-            info = s[p:-3].strip()
-            tattr = {}
-            tattr['info'] = info
-            return ttype, tname, tattr
-        while s[p:p+1] not in ('>', '/', ' ', '"', "'", "\r", "\n"):
-            p += 1
-        tname=s[b:p].lower()
         # some special cases
-        if tname == "!--":
-            ttype = 'passthru'
-            info = s[p:-3]
-            tattr = {}
-            tattr['info'] = info
         if tname == "!doctype":
             tname = "!DOCTYPE"
             ttype = 'passthru'
-            info = s[p:-1]
-            tattr = {}
-            tattr['info'] = info
-        if tname == "![cdata[*":
+            tattr = {'info': s[p:-1]}
+        elif tname == "![cdata[*":
             tname = "![CDATA[*"
             ttype = 'passthru'
-            info = s[p:-1]
-            tattr = {}
-            tattr['info'] = info
-        if tname == "svg":
+            tattr = {'info': s[p:-1]}
+        elif tname == "svg":
             if ttype == 'end':
                 ttype = 'passthru-end'
             else:
                 ttype = 'passthru'
-            info = s[p:-1]
-            tattr = {}
-            tattr['info'] = info
-        if tname.startswith("?"):
+            tattr = {'info': s[p:-1]}
+        elif tname.startswith("?"):
             ttype = 'passthru'
-            info = s[p:-2]
-            tattr = {}
-            tattr['info'] = info
+            tattr = {'info': s[p:-2]}
 
         if ttype is None:
             # parse any attributes
-            # tattr = {}
-            # tattr = self.parse_attr(s,p)
-
             tattr = OrderedDict()
-            while s.find('=',p) != -1 :
-                while s[p:p+1] in (' ', '\r', '\n') : p += 1
-                b = p
-                while s[p:p+1] != '=' : p += 1
-                aname = s[b:p]
-                if aname.strip() not in SVG_ATTR:
-                    aname = aname.lower()
-                aname = aname.rstrip()
-                p += 1
-                while s[p:p+1] == ' ' : p += 1
-                if s[p:p+1] == '"' :
-                    p = p + 1
-                    b = p
-                    while s[p:p+1] != '"': p += 1
-                    val = s[b:p]
-                    p += 1
-                else :
-                    b = p
-                    while s[p:p+1] not in ('>', '/', ' ') : p += 1
-                    val = s[b:p]
-                tattr[aname] = val
-
-        if tattr and len(tattr)== 0: tattr = None
-
-        # label beginning and single tags
-        if not ttype:
+            for am in TAG_ATTR.finditer(s, p):
+                aname, qval, val = am.groups('')
+                tattr[attr_name(aname).rstrip()] = qval or val
+                p = am.end()
+
+            # label beginning and single tags
             ttype = 'begin'
             if s.find(' /',p) >= 0:
                 ttype = 'single_ext'
@@ -197,113 +393,102 @@ class MarkupParser(object):
 
     # main routine to process the xhtml markup language
     def processml(self):
-        htmlstr = ''
-        skip = False
+        return ''.join(self.iter_processml())
+
+    # yields the processed xhtml a chunk at a time so callers can
+    # join it once or write it straight out
+    def iter_processml(self):
+        return iter_apply_edits(self.wipml, self.iter_edits())
+
+    # list of (start, end, replacement) edits against the original markup,
+    # empty when processing would leave the markup unchanged
+    def edits(self):
+        return list(self.iter_edits())
+
+    # (start, end) offsets of the begin and single tags the criteria match,
+    # found without building any output
+    def matches(self):
+        return list(self.iter_matches())
+
+    def iter_matches(self):
+        rules = self.criteria
+        tags = rules.tags
+        wipml = self.wipml
+        for m in ML_SCANNER.finditer(wipml, self.pos):
+            if m.lastgroup != 'tag':
+                continue
+            start, end = m.span()
+            # most tags are told apart by their name alone
+            end_slash, comment, name = TAG_HEAD.match(wipml, start, end).groups()
+            if end_slash is not None or name is None or name.lower() not in tags:
+                continue
+            ttype, tname, tattr = self.parsetag(m.group())
+            if ttype in BEGIN_TYPES and rules.apply(tname, tattr)[0]:
+                yield start, end
+
+    def iter_edits(self):
+        rules = self.criteria
+        tags = rules.tags
+        # only re-serialize matched tags (and their end tags) and copy
+        # everything else straight from the original markup
+        verbatim = rules.verbatim
+        path = self.path
+        checkpoint = self.checkpoint
 
         # now parse the cleaned up ml into standard xhtml
-        while True:
-
-            r = self.parseml()
-            if not r:
-                break
-
-            text, tag = r
-
-            if text:
-                if not skip:
-                    htmlstr += text
-
-            if tag:
-                ttype, tname, tattr = self.parsetag(tag)
-
-                # mark any tags to remove/modify
-                if self.attrib is not None: # Tags with attributes
-                    if tname == self.tag and ttype in ('begin', 'single', 'single_ext') and self.attrib in tattr.keys() and attrMatch(tattr[self.attrib], self.srch_method, self.srch_str):
-                        if self.action == 'delete':
-                            tname = 'removeme:{0}'.format(tname)
-                            tattr = None
-                        elif self.action == 'modify':
-                            if self.new_tag is None:
-                                tname = 'changeme:{0}'.format(tname)
-                            else:
-                                tname = 'changeme:{0}'.format(self.new_tag)
-                            if not self.copy_attr:
-                                if not len(self.new_str):
-                                    tattr = None
-                                else:
-                                    tattr = self.parse_new_tattr(self.new_str)
-                else:  # Tags without any attributes
-                    if tname == self.tag and ttype in ('begin', 'single', 'single_ext') and not len(tattr):
-                        if self.action == 'delete':
-                            tname = 'removeme:{0}'.format(tname)
-                            tattr = None
-                        elif self.action == 'modify':
-                            if self.new_tag is None:
-                                tname = 'changeme:{0}'.format(tname)
-                            else:
-                                tname = 'changeme:{0}'.format(self.new_tag)
-                            if not len(self.new_str):
-                                tattr = None
-                            else:
-                                tattr = self.parse_new_tattr(self.new_str)
-
-                if tname == self.tag and ttype == 'end':
-                    if self.action == 'delete':
-                        if self.path[-1] == 'removeme:{0}'.format(tname):
-                            tname = 'removeme:{0}'.format(tname)
-                            tattr = None
-                    elif self.action == 'modify':
-                        if self.new_tag is None:
-                            if self.path[-1] == 'changeme:{0}'.format(tname):
-                                tname = 'changeme:{0}'.format(tname)
-                        else:
-                            if self.path[-1] == 'changeme:{0}'.format(self.new_tag):
-                                tname = 'changeme:{0}'.format(self.new_tag)
-                        tattr = None
-
-                # keep track of nesting path
-                # special case xml doctype
-                # if ttype == 'begin' and tname != '?xml' and tname != '!DOCTYPE':
-                # should not need the previous if ttype cannot possibly equal both 'begin' and 'passthrough'.
-                if ttype == 'begin':
-                    self.path.append(tname)
-                elif ttype == 'end':
-                    if tname != self.path[-1]:
-                        print ('improper nesting: ', self.path, tname, type)
-                    self.path.pop()
-
-                if tname == 'removeme:{0}'.format(tname):
-                    if ttype in ('begin', 'single', 'single_ext'):
-                        skip = True
-                    else:
-                        skip = False
-                else:
-                    taginfo = (ttype, tname, tattr)
-                    htmlstr += self.processtag(taginfo)
-
-        return htmlstr
+        for text, tag in self.iterml():
+            if not tag:
+                continue
+            if checkpoint is not None:
+                checkpoint()
+            ttype, tname, tattr = self.parsetag(tag)
+            src_name = tname
+            flag = 0
+
+            # mark any tags to remove/modify
+            if ttype in BEGIN_TYPES:
+                if tname in tags:
+                    flag, tname, tattr = rules.apply(tname, tattr)
+            elif ttype == 'end' and tname in tags:
+                # the end tag of a removed or changed tag goes the same way
+                top_name, top_flag, top_src = path[-1]
+                if top_flag and top_src == tname:
+                    flag = top_flag
+                    tname = top_name
+
+            # keep track of nesting path
+            if ttype == 'begin':
+                path.append((tname, flag, src_name))
+            elif ttype == 'end':
+                if (tname, flag) != path[-1][:2]:
+                    print ('improper nesting: ', path, tname, type)
+                path.pop()
+
+            if flag == REMOVE:
+                yield self.pos - len(tag), self.pos, ''
+            # untouched tags stay as they are in the original
+            # markup when running verbatim
+            elif flag or not verbatim:
+                res = self.processtag((ttype, tname, tattr))
+                if res != tag:
+                    yield self.pos - len(tag), self.pos, res
 
     # flatten possibly modified tag back to string
     def taginfo_tostring(self, taginfo):
         (ttype, tname, tattr) = taginfo
-        res = '<'
         if ttype == 'end':
-            res += '/' + tname + '>'
-            return res
-        res += tname
+            return '</' + tname + '>'
+        res = ['<', tname]
         if tattr:
-            for key in tattr.keys():
-                res += ' '
-                res += key + '="'
-                res += tattr[key] + '"'
-            res == ' '
+            for key, val in tattr.items():
+                res.extend((' ', key, '="', val, '"'))
         if ttype == 'single':
-            res += '/>'
+            res.append('/>')
         elif ttype == 'single_ext':
-            res += ' />'
+            res.append(' />')
         else :
-            res += '>'
-        return res
+            res.append('>')
+        return ''.join(res)
 
     # routines to allow preprocessing and conversion of tags
     def processtag(self, taginfo):
@@ -313,10 +498,8 @@ class MarkupParser(object):
 
         # put any code here to manipulate or process tags
 
-        if tname is None or tname.startswith('removeme'):
+        if tname is None:
             return ''
-        if tname.startswith('changeme'):
-            tname = tname[9:]
         if tattr is None:
             tattr = {}
 
@@ -377,9 +377,14 @@ smartypants.py license::
 """
 
 default_smartypants_attr = "1"
-apos_words_list = []
-AMP = ''
 
+# The ways educate_quotes() can be done, see SmartyPants.scan_quotes()
+QUOTES_REGEX = "regex"
+QUOTES_SCAN = "scan"
+
+
+import threading
+from collections import OrderedDict, namedtuple
 
 try:
     import regex as re
@@ -388,6 +393,8 @@ except ImportError:
 
 # style added by Kovid
 tags_to_skip_regex = re.compile(r"<(/)?(style|pre|code|kbd|script|math)[^>]*>", re.I)
+# the same, by element name
+tags_to_skip = frozenset(('style', 'pre', 'code', 'kbd', 'script', 'math'))
 self_closing_regex = re.compile(r'/\s*>$')
 
 
@@ -428,313 +435,863 @@ def cb_story(args):
 
 # interal functions below here
 
-def smartyPants(text, attr=default_smartypants_attr, ampersand='', words_list=None):
-    global apos_words_list
-    global AMP
-    AMP = ampersand
-    apos_words_list = words_list
-    convert_quot = False  # should we translate &quot; entities into normal quotes?
-
-    # Parse attributes:
-    # 0 : do nothing
-    # 1 : set all
-    # 2 : set all, using old school en- and em- dash shortcuts
-    # 3 : set all, using inverted old school en and em- dash shortcuts
-    #
-    # q : quotes
-    # b : backtick quotes (``double'' only)
-    # B : backtick quotes (``double'' and `single')
-    # d : dashes
-    # D : old school dashes
-    # i : inverted old school dashes
-    # e : ellipses
-    # w : convert &quot; entities to " for Dreamweaver users
-
-    skipped_tag_stack = []
-    do_dashes = "0"
-    do_backticks = "0"
-    do_quotes = "0"
-    do_ellipses = "0"
-    do_stupefy = "0"
-
-    if attr == "0":
-        # Do nothing.
-        return text
-    elif attr == "1":
-        do_quotes    = "1"
-        do_backticks = "1"
-        do_dashes    = "1"
-        do_ellipses  = "1"
-    elif attr == "2":
-        # Do everything, turn all options on, use old school dash shorthand.
-        do_quotes    = "1"
-        do_backticks = "1"
-        do_dashes    = "2"
-        do_ellipses  = "1"
-    elif attr == "3":
-        # Do everything, turn all options on, use inverted old school dash shorthand.
-        do_quotes    = "1"
-        do_backticks = "1"
-        do_dashes    = "3"
-        do_ellipses  = "1"
-    elif attr == "-1":
-        # Special "stupefy" mode.
-        do_stupefy   = "1"
-    else:
-        for c in attr:
-            if c == "q":
-                do_quotes = "1"
-            elif c == "b":
-                do_backticks = "1"
-            elif c == "B":
-                do_backticks = "2"
-            elif c == "d":
-                do_dashes = "1"
-            elif c == "D":
-                do_dashes = "2"
-            elif c == "i":
-                do_dashes = "3"
-            elif c == "e":
-                do_ellipses = "1"
-            elif c == "w":
-                convert_quot = "1"
-            else:
-                pass
-                # ignore unknown option
-
-    tokens = _tokenize(text)
-    result = []
-    in_pre = False
-
-    prev_token_last_char = ""
-    # This is a cheat, used to get some context
-    # for one-character tokens that consist of
-    # just a quote char. What we do is remember
-    # the last character of the previous text
-    # token, to use as context to curl single-
-    # character quote tokens correctly.
-
-    for cur_token in tokens:
-        if cur_token[0] == "tag":
-            # Don't mess with quotes inside some tags.  This does not handle self <closing/> tags!
-            result.append(cur_token[1])
-            skip_match = tags_to_skip_regex.match(cur_token[1])
-            if skip_match is not None:
-                is_self_closing = self_closing_regex.search(skip_match.group()) is not None
-                if not is_self_closing:
-                    if not skip_match.group(1):
-                        skipped_tag_stack.append(skip_match.group(2).lower())
-                        in_pre = True
-                    else:
-                        if len(skipped_tag_stack) > 0:
-                            if skip_match.group(2).lower() == skipped_tag_stack[-1]:
-                                skipped_tag_stack.pop()
-                            else:
-                                pass
-                                # This close doesn't match the open.  This isn't XHTML.  We should barf here.
-                        if len(skipped_tag_stack) == 0:
-                            in_pre = False
-        else:
-            t = cur_token[1]
-            last_char = t[-1:]  # Remember last char of this token before processing.
-            if not in_pre:
-                t = processEscapes(t)
-
-                if convert_quot != "0":
-                    t = re.sub('&quot;', '"', t)
-
-                if do_dashes != "0":
-                    if do_dashes == "1":
-                        t = educateDashes(t)
-                    if do_dashes == "2":
-                        t = educateDashesOldSchool(t)
-                    if do_dashes == "3":
-                        t = educateDashesOldSchoolInverted(t)
-
-                if do_ellipses != "0":
-                    t = educateEllipses(t)
-
-                # Note: backticks need to be processed before quotes.
-                if do_backticks != "0":
-                    t = educateBackticks(t)
-
-                if do_backticks == "2":
-                    t = educateSingleBackticks(t)
-
-                if do_quotes != "0":
-                    if t == "'":
-                        # Special case: single-character ' token
-                        if re.match("\S", prev_token_last_char):
-                            t = "&#8217;"
-                        else:
-                            t = "&#8216;"
-                    elif t == '"':
-                        # Special case: single-character " token
-                        if re.match("\S", prev_token_last_char):
-                            t = "&#8221;"
-                        else:
-                            t = "&#8220;"
+def smartyPants(text, attr=default_smartypants_attr, ampersand='', words_list=None, checkpoint=None,
+                quote_engine=QUOTES_REGEX, use_unicode=False):
+    config = SmartyPantsConfig(attr, ampersand, words_list, quote_engine=quote_engine, use_unicode=use_unicode)
+    return get_engine(config).process(text, checkpoint)
 
-                    else:
-                        # Normal case:
-                        t = educateQuotes(t)
 
-                if do_stupefy == "1":
-                    t = stupefyEntities(t)
+class SmartyPantsConfig(namedtuple('SmartyPantsConfig',
+                                     'attr ampersand words_list apos_ignore_case quote_engine use_unicode')):
+    """
+    Everything that decides what smartyPants() does with a text:
+
+    attr: the smartypants attribute string ("1", "2", "qbde", ...).
+    ampersand: what stands in for '&' in the text. With '&' itself the
+    entities already in the text are taken as they are: none of them is
+    ever changed (no &quot; conversion or stupefying), and the quotes next
+    to one go by its '&' and ';', as they would by punctuation.
+    words_list: words that take an apostrophe rather than an opening
+    quote, without the apostrophe.
+    apos_ignore_case: match words_list regardless of case.
+    quote_engine: QUOTES_REGEX or QUOTES_SCAN.
+    use_unicode: write the characters themselves rather than the entities
+    for them (&#8220; and so on). The entities already in the text are
+    left as they are either way.
+
+    Being a (hashable, immutable) tuple it doubles as the engine cache key.
+    """
+    __slots__ = ()
+
+    def __new__(cls, attr=default_smartypants_attr, ampersand='', words_list=None, apos_ignore_case=False,
+                quote_engine=QUOTES_REGEX, use_unicode=False):
+        return super(SmartyPantsConfig, cls).__new__(cls, attr, ampersand, tuple(words_list or ()),
+                                                     bool(apos_ignore_case), quote_engine, bool(use_unicode))
 
-            prev_token_last_char = last_char
-            result.append(t)
 
-    return "".join(result)
+def trie_pattern(words):
+    """
+    Parameter:  Iterable of plain (not regex) strings.
+    Returns:    A regular expression matching any one of them, with common
+                prefixes factored out so that matching never has to try
+                more than one alternative per character.
+
+    Example input:  ['tis', 'twas', 'em']
+    Example output: (?:em|t(?:is|was))
+    """
+    trie = {}
+    for word in words:
+        if not word:
+            continue
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = None  # a word ends here
+
+    def build(node):
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ''
+        if len(alts) == 1:
+            pattern = alts[0]
+            if '' in node:
+                pattern = '(?:%s)?' % pattern
+        else:
+            pattern = '(?:%s)' % '|'.join(alts)
+            if '' in node:
+                pattern += '?'
+        return pattern
+
+    return build(trie)
+
+
+# Patterns that don't depend on the configuration are compiled once, here.
+# The ones that do are compiled by each SmartyPants engine.
+
+punct_class = r"""[!"#\$\%'()*+,-.\/:;<=>?\@\[\\\]\^_`{|}~]"""
+close_class = r"""[^\ \t\r\n\[\{\(\-]"""
+
+non_space_regex = re.compile(r"\S")
+
+# Special case if the very first character is a quote
+# followed by punctuation at a non-word-break. Close the quotes by brute force:
+first_single_regex = re.compile(r"""^'(?=%s\\B)""" % (punct_class,), re.U)
+first_double_regex = re.compile(r"""^"(?=%s\\B)""" % (punct_class,), re.U)
+
+# Special case for double sets of quotes, e.g.:
+#   <p>He said, "'Quoted' words in a larger quote."</p>
+double_sets_regexes = (
+    (re.compile(r""""'(?=\w)""", re.U), """&#8220;&#8216;"""),
+    (re.compile(r"""'"(?=\w)""", re.U), """&#8216;&#8220;"""),
+    (re.compile(r'''""(?=\w)''', re.U), """&#8220;&#8220;"""),
+    (re.compile(r"""''(?=\w)""", re.U), """&#8216;&#8216;"""),
+)
+double_sets_literals = (
+    ('"\'', """&#8221;&#8217;"""),
+    ('\'"', """&#8217;&#8221;"""),
+    ('""', """&#8221;&#8221;"""),
+    ("''", """&#8217;&#8217;"""),
+)
+
+# Special case for decade abbreviations (the '80s --> ’80s):
+# See http://practicaltypography.com/apostrophes.html
+decade_regex = re.compile(r"""(\W|^)'(?=\d{2}s)""", re.U)
+# Measurements in feet and inches or longitude/latitude: 19' 43.5" --> 19′ 43.5″
+measurement_regex = re.compile(r'''(\W|^)([-0-9.]+\s*)'(\s*[-0-9.]+)"''', re.U)
+
+# Special case for Quotes at inside of other entities, e.g.:
+#   <p>A double quote--"within dashes"--would be nice.</p>
+inside_regexes = (
+    (re.compile(r"""(?<=\W)"(?=\w)""", re.U), r"""&#8220;"""),
+    (re.compile(r"""(?<=\W)'(?=\w)""", re.U), r"""&#8216;"""),
+    (re.compile(r"""(?<=\w)"(?=\W)""", re.U), r"""&#8221;"""),
+    (re.compile(r"""(?<=\w)'(?=\W)""", re.U), r"""&#8217;"""),
+)
+
+closing_single_regex = re.compile(r"""
+        (%s)
+        '
+        (?!\p{Zs} | s\b | \d)
+        """ % (close_class,), re.VERBOSE | re.UNICODE)
+
+closing_single_s_regex = re.compile(r"""
+        (%s)
+        '
+        (\p{Zs} | s\b)
+        """ % (close_class,), re.VERBOSE | re.UNICODE)
+
+# Added by Doug {
+closing_single_space_regex = re.compile(r"""
+        #(%s)?   # character that indicates the quote should be closing
+        '
+        (?=\p{Zs})
+        """ % (close_class,), re.VERBOSE | re.UNICODE)
+# }
+
+closing_double_space_regex = re.compile(r"""
+        #(%s)?   # character that indicates the quote should be closing
+        "
+        (?=\p{Zs})
+        """ % (close_class,), re.VERBOSE | re.UNICODE)
+
+closing_double_regex = re.compile(r"""
+        (%s)   # character that indicates the quote should be closing
+        "
+        """ % (close_class,), re.VERBOSE)
+
+# For SmartyPants.scan_quotes():
+quote_split_regex = re.compile(r"""(['"])""")
+# Where the substitutions stop being independent of each other: quotes
+# next to each other, and a quote after ' and an s or space, which
+# closing_single_s_regex takes from it.
+entangled_quotes_regex = re.compile(r"""['"]['"]|'(?:s|(?!\ )\p{Zs})'""", re.UNICODE)
+# What a measurement_regex match has to have in it, far quicker to look for
+measurement_quotes_regex = re.compile(r"""'(?=\s*[-0-9.]+")""", re.UNICODE)
+# What close_class leaves out
+not_closing_chars = frozenset(' \t\r\n[{(-')
+
+WORD_CHAR, SPACE_CHAR, DIGIT_CHAR = 1, 2, 4
+char_class_regexes = ((re.compile(r"\w", re.UNICODE), WORD_CHAR), (re.compile(r"\p{Zs}", re.UNICODE), SPACE_CHAR),
+                      (re.compile(r"\d", re.UNICODE), DIGIT_CHAR))
+
+def char_class(c):
+    """
+    Whether the character c (or '') is a word character, a space or a
+    digit (to the regexes), as WORD_CHAR, SPACE_CHAR and DIGIT_CHAR flags.
+    """
+    flags = 0
+    for regex, flag in char_class_regexes:
+        if regex.match(c):
+            flags |= flag
+    return flags
 
 
-def educateQuotes(str):
+def quote_entity(prev, quote, following):
     """
-    Parameter:  String.
+    Parameter:  The character before a quote ('' at the start of the text),
+                the quote, and up to three characters after it (fewer when
+                the text or the run of text between quotes ends first).
+    Returns:    The entity educate_quotes() turns that quote into, when
+                no other quote is next to it (see SmartyPants.scan_quotes()).
+
+    The tests are those of educate_quotes(), in the same order, bar the
+    apostrophe exceptions, which come before all of them anyway.
+    """
+    prev_class = char_class(prev)
+    next_class = char_class(following[:1])
+    if quote == "'":
+        if not prev and first_single_regex.match(quote + following):
+            return "&#8217;"
+        if (not prev_class & WORD_CHAR and next_class & DIGIT_CHAR and
+                char_class(following[1:2]) & DIGIT_CHAR and following[2:3] == 's'):
+            # decade_regex
+            return "&#8217;"
+        if prev and not prev_class & WORD_CHAR and next_class & WORD_CHAR:
+            return "&#8216;"
+        if prev_class & WORD_CHAR and following and not next_class & WORD_CHAR:
+            return "&#8217;"
+        # opening_single_regex only follows non word characters, a case
+        # the inside_regexes have already taken
+        if prev and prev not in not_closing_chars and not next_class & DIGIT_CHAR:
+            # closing_single_regex and closing_single_s_regex
+            return "&#8217;"
+        if next_class & SPACE_CHAR:
+            return "&#8217;"
+        return "&#8216;"
+    else:
+        if not prev and first_double_regex.match(quote + following):
+            return "&#8221;"
+        if prev and not prev_class & WORD_CHAR and next_class & WORD_CHAR:
+            return "&#8220;"
+        if prev_class & WORD_CHAR and following and not next_class & WORD_CHAR:
+            return "&#8221;"
+        # as for opening_single_regex, opening_double_regex never gets here
+        if next_class & SPACE_CHAR:
+            return "&#8221;"
+        if prev and prev not in not_closing_chars:
+            return "&#8221;"
+        if not following and prev == '-':
+            # A string that endswith -" is sometimes used for dialogue
+            return "&#8221;"
+        return "&#8220;"
+
+
+# quote_entity() for the quote contexts seen so far, shared by every engine,
+# and the same written as characters
+_quote_entities = {}
+_quote_chars = {}
+QUOTE_ENTITIES_CACHE_SIZE = 50000
+
+spaced_ellipsis_regex = re.compile(r"""\.\p{Zs}\.\p{Zs}\.""", re.UNICODE)
+
+# The fixed substitutions made to every text token, as (pattern, literal
+# replacement) pairs: processEscapes(), the &quot; conversion, each style
+# of dashes, educateEllipses() and stupefyEntities(). An engine joins the
+# ones it needs into a single pattern, see SmartyPants.fused_regex.
+ESCAPE_RULES = (
+    (r"""\\\\""", r"""&#92;"""),
+    (r'''\\"''', r"""&#34;"""),
+    (r"""\\'""", r"""&#39;"""),
+    (r"""\\\.""", r"""&#46;"""),
+    (r"""\\-""", r"""&#45;"""),
+    (r"""\\`""", r"""&#96;"""),
+)
+QUOT_RULES = (
+    (r"""&quot;""", '"'),
+)
+DASH_RULES = {
+    # triple dashes are left alone, as is the placeholder
+    # educateDashes() uses to protect them
+    "1": (
+        (r"""---""", r"""---"""),
+        (r"""--""", r"""&#8212;"""),
+        (r"""\^tripledash\^""", r"""---"""),
+    ),
+    "2": (
+        (r"""---""", r"""&#8212;"""),
+        (r"""--""", r"""&#8211;"""),
+    ),
+    "3": (
+        (r"""---""", r"""&#8211;"""),
+        (r"""--""", r"""&#8212;"""),
+    ),
+}
+ELLIPSIS_RULES = (
+    (r"""\.\.\.""", r"""&#8230;"""),
+    # educateEllipses() turns "..." into entities before looking for the
+    # spaced kind, so the last dot mustn't start a "..." of its own
+    (r"""\.\p{Zs}\.\p{Zs}\.(?!\.\.)""", r"""&#8230;"""),
+)
+STUPEFY_RULES = (
+    (r"""&#8211;""", r"""-"""),
+    (r"""&#8212;""", r"""--"""),
+    (r"""&#8216;""", r"""'"""),
+    (r"""&#8217;""", r"""'"""),
+    (r"""&#8220;""", r'''"'''),
+    (r"""&#8221;""", r'''"'''),
+    (r"""&#8230;""", r"""..."""),
+)
+# educateBackticks() and educateSingleBackticks()
+BACKTICK_RULES = (
+    ("``", r"""&#8220;"""),
+    ("''", r"""&#8221;"""),
+)
+SINGLE_BACKTICK_RULES = (
+    ("`", r"""&#8216;"""),
+    ("'", r"""&#8217;"""),
+)
+
+# The characters of all the entities smartyPants() makes, which an engine
+# with use_unicode writes instead (see unicode_marks()).
+ENTITY_CHARS = {
+    "&#8211;": u"\u2013",
+    "&#8212;": u"\u2014",
+    "&#8216;": u"\u2018",
+    "&#8217;": u"\u2019",
+    "&#8220;": u"\u201c",
+    "&#8221;": u"\u201d",
+    "&#8230;": u"\u2026",
+    "&#8242;": u"\u2032",
+    "&#8243;": u"\u2033",
+    "&#92;": u"\\",
+    "&#34;": u'"',
+    "&#39;": u"'",
+    "&#46;": u".",
+    "&#45;": u"-",
+    "&#96;": u"`",
+}
+entity_mark_regex = re.compile(r"&#\d+;")
+
+def unicode_marks(repl):
+    """
+    Parameter:  A replacement from the tables above.
+    Returns:    The same, with the entities it makes written as characters.
+    """
+    return entity_mark_regex.sub(lambda m: ENTITY_CHARS.get(m.group(), m.group()), repl)
+
+# With use_unicode an escaped character is written as one of these while
+# the rest of its token is worked on, so that the quote rules take it as
+# they would the entity, and not as a quote, dash or dot of the text. They
+# are Unicode noncharacters, which are set aside for this kind of use.
+ESCAPE_STAND_INS = {
+    "&#92;": u"\ufdd0",
+    "&#34;": u"\ufdd1",
+    "&#39;": u"\ufdd2",
+    "&#46;": u"\ufdd3",
+    "&#45;": u"\ufdd4",
+    "&#96;": u"\ufdd5",
+}
+escaped_chars = dict((ord(stand_in), ENTITY_CHARS[entity]) for entity, stand_in in ESCAPE_STAND_INS.items())
+
+
+class SmartyPants(object):
+    """
+    The smartyPants() conversion for one SmartyPantsConfig, with every
+    pattern it needs compiled up front.
+
+    An engine is never changed after it is built, so one engine can be used
+    by any number of threads at once. Engines are costly to build and cheap
+    to use; get_engine() keeps the recently used ones around.
+    """
+
+    def __init__(self, config=None):
+        if config is None:
+            config = SmartyPantsConfig()
+        self.config = config
+        attr = self.attr = config.attr
+        ampersand = self.ampersand = config.ampersand
+        self.words_list = config.words_list
+
+        # Everything this engine makes is written the one way or the other
+        self.use_unicode = config.use_unicode
+        mark = unicode_marks if self.use_unicode else (lambda repl: repl)
+        self.lsquo, self.rsquo = mark("&#8216;"), mark("&#8217;")
+        self.ldquo, self.rdquo = mark("&#8220;"), mark("&#8221;")
+        self.prime, self.dprime = mark("&#8242;"), mark("&#8243;")
+        self.backtick_rules = tuple((chars, mark(repl)) for chars, repl in BACKTICK_RULES)
+        self.single_backtick_rules = tuple((chars, mark(repl)) for chars, repl in SINGLE_BACKTICK_RULES)
+        self.double_sets_regexes = tuple((regex, mark(repl)) for regex, repl in double_sets_regexes)
+        self.double_sets_literals = tuple((quotes, mark(repl)) for quotes, repl in double_sets_literals)
+        self.inside_regexes = tuple((regex, mark(repl)) for regex, repl in inside_regexes)
+        self.quote_marks = _quote_chars if self.use_unicode else _quote_entities
+
+        # Parse attributes:
+        # 0 : do nothing
+        # 1 : set all
+        # 2 : set all, using old school en- and em- dash shortcuts
+        # 3 : set all, using inverted old school en and em- dash shortcuts
+        #
+        # q : quotes
+        # b : backtick quotes (``double'' only)
+        # B : backtick quotes (``double'' and `single')
+        # d : dashes
+        # D : old school dashes
+        # i : inverted old school dashes
+        # e : ellipses
+        # w : convert &quot; entities to " for Dreamweaver users
+
+        convert_quot = False  # should we translate &quot; entities into normal quotes?
+        do_dashes = "0"
+        do_backticks = "0"
+        do_quotes = "0"
+        do_ellipses = "0"
+        do_stupefy = "0"
+
+        if attr == "1":
+            do_quotes    = "1"
+            do_backticks = "1"
+            do_dashes    = "1"
+            do_ellipses  = "1"
+        elif attr == "2":
+            # Do everything, turn all options on, use old school dash shorthand.
+            do_quotes    = "1"
+            do_backticks = "1"
+            do_dashes    = "2"
+            do_ellipses  = "1"
+        elif attr == "3":
+            # Do everything, turn all options on, use inverted old school dash shorthand.
+            do_quotes    = "1"
+            do_backticks = "1"
+            do_dashes    = "3"
+            do_ellipses  = "1"
+        elif attr == "-1":
+            # Special "stupefy" mode.
+            do_stupefy   = "1"
+        elif attr != "0":
+            for c in attr:
+                if c == "q":
+                    do_quotes = "1"
+                elif c == "b":
+                    do_backticks = "1"
+                elif c == "B":
+                    do_backticks = "2"
+                elif c == "d":
+                    do_dashes = "1"
+                elif c == "D":
+                    do_dashes = "2"
+                elif c == "i":
+                    do_dashes = "3"
+                elif c == "e":
+                    do_ellipses = "1"
+                elif c == "w":
+                    convert_quot = "1"
+                else:
+                    pass
+                    # ignore unknown option
+
+        # Leave the text's own entities alone, see SmartyPantsConfig
+        self.opaque_entities = ampersand == "&"
+        if self.opaque_entities:
+            convert_quot = "0"
+            do_stupefy = "0"
+
+        # (convert_quot starts out False, which isn't "0", so &quot; is always converted)
+        self.convert_quot = convert_quot != "0"
+        self.do_dashes = do_dashes
+        self.do_backticks = do_backticks
+        self.do_quotes = do_quotes != "0"
+        self.do_ellipses = do_ellipses != "0"
+        self.do_stupefy = do_stupefy == "1"
+
+        # Everything up to the backticks, in one scan of each token. Each
+        # rule starts with a different character, or a longer form of the
+        # same one comes first, so the leftmost match is always the one the
+        # separate substitutions would have made. Stupefying comes last, so
+        # it can only join in when nothing that comes in between is on.
+        rules = ESCAPE_RULES
+        if self.convert_quot:
+            rules += QUOT_RULES
+        if self.do_dashes != "0":
+            rules += DASH_RULES[self.do_dashes]
+        if self.do_ellipses:
+            rules += ELLIPSIS_RULES
+        self.fuse_stupefy = (self.do_stupefy and not self.do_quotes and self.do_backticks == "0")
+        if self.fuse_stupefy:
+            rules += STUPEFY_RULES
+        self.fused_regex = re.compile('|'.join('(%s)' % pattern for pattern, repl in rules), re.UNICODE)
+        # the tokens that come down to a lone quote, whose result depends on
+        # the text before them (see educate_text)
+        self.lone_quotes = frozenset(("'", '"', "&quot;") if self.convert_quot else ("'", '"'))
+        self.fused_repl = [None] + [mark(ESCAPE_STAND_INS.get(repl, repl)) if self.use_unicode else repl
+                                    for pattern, repl in rules]
+
+        # Every rule needs one of these characters to do anything, so a
+        # text token without any of them comes through unchanged.
+        triggers = set('\\')
+        if self.convert_quot or self.do_stupefy:
+            triggers.add('&')
+        if self.do_dashes != "0":
+            triggers.update('-^')
+        if self.do_ellipses:
+            triggers.add('.')
+        if self.do_backticks != "0":
+            triggers.update("`'")
+        if self.do_quotes:
+            triggers.update('\'"')
+        self.trigger_regex = re.compile('[%s]' % ''.join(re.escape(c) for c in sorted(triggers)))
+
+        # The words beginning with an apostrophe - in apos_exception.txt file.
+        # One on each line - WITHOUT the apostrophe. They are taken literally,
+        # and all looked for at once.
+        self.apos_regex = apos_matcher(self.words_list, config.apos_ignore_case)
+
+        AMP = ampersand
+        dec_dashes = r"""%s#8211;|%s#8212;""".format(AMP, AMP)
+
+        # What an opening quote can come after
+        opening_context = r"""
+                    \p{Zs}       |   # a whitespace char, or
+                    %snbsp;      |   # a non-breaking space entity, or
+                    %s\#160;     |
+                    --           |   # dashes, or
+                    %s[mn]dash;  |   # named dash entities
+                    %s           |   # or decimal entities
+                    %s\#x201[34];    # or hex
+                """ % (AMP, AMP, AMP, dec_dashes, AMP,)
+
+        # Get most opening single quotes:
+        self.opening_single_regex = re.compile(r"""
+                (%s)
+                '                    # the quote
+                (?=\w)               # followed by a word character
+                """ % (opening_context,), re.VERBOSE | re.UNICODE)
+
+        # Get most opening double quotes:
+        self.opening_double_regex = re.compile(r"""
+                (%s)
+                "                    # the quote
+                (?=\w)               # followed by a word character
+                """ % (opening_context,), re.VERBOSE | re.UNICODE)
+
+        # The scan relies on no test looking past the characters next to a
+        # quote for another one, which a quote in the ampersand would upset.
+        self.scan = config.quote_engine == QUOTES_SCAN and "'" not in AMP and '"' not in AMP
+
+    def process(self, text, checkpoint=None, stats=None, cache=None):
+        """
+        Smarten text. If given, checkpoint is called before each text token
+        and may raise to stop. stats, a dict, has the number of text tokens
+        looked at added to its 'tokens' and the number of those that had
+        nothing to smarten in them to its 'skipped'. With a TokenCache as
+        cache, text tokens smartened before are looked up in it, and the
+        number of those is added to stats' 'cached'.
+        """
+        if self.attr == "0":
+            # Do nothing.
+            return text
+        return "".join(self.chunks(text, checkpoint, stats, cache))
+
+    def chunks(self, text, checkpoint=None, stats=None, cache=None):
+        """
+        The same as process(), as the pieces of the smartened text in order,
+        each worked out only when it is asked for. stats is only added to
+        once the last piece has been.
+        """
+        if self.attr == "0":
+            return iter((text,))
+        return self.educate_tokens(_tokenize(text), checkpoint, stats, cache)
+
+    def educate_tokens(self, tokens, checkpoint=None, stats=None, cache=None):
+        """
+        What chunks() does with the (type, value) tokens of _tokenize(), for
+        any other source of them. Given nothing but text tokens (the runs of
+        text of a parsed document, say) it yields each one smartened.
+        """
+        skipped_tag_stack = []
+        in_pre = False
+
+        trigger_search = self.trigger_regex.search
+        token_count = skipped_count = cached_count = 0
+        max_cached_length = cache.max_token_length if cache is not None else -1
+
+        prev_token_last_char = ""
+        # This is a cheat, used to get some context
+        # for one-character tokens that consist of
+        # just a quote char. What we do is remember
+        # the last character of the previous text
+        # token, to use as context to curl single-
+        # character quote tokens correctly.
+
+        for type_, t in tokens:
+            if type_ == "tag":
+                # Don't mess with quotes inside some tags.  This does not handle self <closing/> tags!
+                yield t
+                skip_match = tags_to_skip_regex.match(t)
+                if skip_match is not None:
+                    is_self_closing = self_closing_regex.search(skip_match.group()) is not None
+                    if not is_self_closing:
+                        if not skip_match.group(1):
+                            skipped_tag_stack.append(skip_match.group(2).lower())
+                            in_pre = True
+                        else:
+                            if len(skipped_tag_stack) > 0:
+                                if skip_match.group(2).lower() == skipped_tag_stack[-1]:
+                                    skipped_tag_stack.pop()
+                                else:
+                                    pass
+                                    # This close doesn't match the open.  This isn't XHTML.  We should barf here.
+                            if len(skipped_tag_stack) == 0:
+                                in_pre = False
+            else:
+                # give the caller a chance to stop us part way through
+                if checkpoint is not None:
+                    checkpoint()
+                last_char = t[-1:]  # Remember last char of this token before processing.
+                if not in_pre:
+                    token_count += 1
+                    if trigger_search(t) is None:
+                        skipped_count += 1
+                    elif len(t) <= max_cached_length:
+                        # The previous token only matters to a lone quote
+                        if t in self.lone_quotes:
+                            key = (self, t, non_space_regex.match(prev_token_last_char) is not None)
+                        else:
+                            key = (self, t)
+                        educated = cache.get(key)
+                        if educated is None:
+                            educated = self.educate_text(t, prev_token_last_char)
+                            cache.put(key, t, educated)
+                        else:
+                            cached_count += 1
+                        t = educated
+                    else:
+                        t = self.educate_text(t, prev_token_last_char)
+                prev_token_last_char = last_char
+                yield t
+
+        if stats is not None:
+            stats['tokens'] = stats.get('tokens', 0) + token_count
+            stats['skipped'] = stats.get('skipped', 0) + skipped_count
+            if cache is not None:
+                stats['cached'] = stats.get('cached', 0) + cached_count
+
+    # everything done to a text token outside of the skipped tags
+    def educate_text(self, t, prev_token_last_char):
+        # escapes need a backslash, see ESCAPE_STAND_INS
+        escaped = self.use_unicode and '\\' in t
+
+        # escapes, &quot;, dashes and ellipses (and stupefying when on its own)
+        t = self.fused_regex.sub(self.fused_sub, t)
+
+        # Note: backticks need to be processed before quotes.
+        if self.do_backticks != "0":
+            for chars, repl in self.backtick_rules:
+                t = t.replace(chars, repl)
+
+        if self.do_backticks == "2":
+            for chars, repl in self.single_backtick_rules:
+                t = t.replace(chars, repl)
+
+        if self.do_quotes:
+            if t == "'":
+                # Special case: single-character ' token
+                if non_space_regex.match(prev_token_last_char):
+                    t = self.rsquo
+                else:
+                    t = self.lsquo
+            elif t == '"':
+                # Special case: single-character " token
+                if non_space_regex.match(prev_token_last_char):
+                    t = self.rdquo
+                else:
+                    t = self.ldquo
+
+            elif self.scan:
+                t = self.scan_quotes(t)
+            else:
+                # Normal case:
+                t = self.educate_quotes(t)
+
+        if self.do_stupefy and not self.fuse_stupefy:
+            t = stupefyEntities(t)
+
+        if escaped:
+            t = t.translate(escaped_chars)
+        return t
+
+    def fused_sub(self, m):
+        return self.fused_repl[m.lastindex]
+
+    def educate_quotes(self, str):
+        if self.apos_regex is not None:
+            str = self.apos_regex.sub(self.rsquo, str)
+
+        str = first_single_regex.sub(self.rsquo, str)
+        str = first_double_regex.sub(self.rdquo, str)
+
+        for regex, repl in self.double_sets_regexes:
+            str = regex.sub(repl, str)
+        for quotes, repl in self.double_sets_literals:
+            str = str.replace(quotes, repl)
+
+        str = decade_regex.sub(r"""\1""" + self.rsquo, str)
+        str = measurement_regex.sub(r'\1\2' + self.prime + r'\3' + self.dprime, str)
+
+        for regex, repl in self.inside_regexes:
+            str = regex.sub(repl, str)
+
+        # The following are commented out as smartypants tokenizes text by
+        # stripping out html tags. Therefore, there is no guarantee that the
+        # start-of-line and end-ol-line regex operators will match anything
+        # meaningful
+
+        # Special case for Quotes at end of line with a preceeding space (may change just to end of line)
+        # str = re.sub(r"""(?<=\s)"$""", r"""&#8221;""", str)
+        # str = re.sub(r"""(?<=\s)'$""", r"""&#8217;""", str)
+
+        # Special case for Quotes at beginning of line with a space - multiparagraph quoted text:
+        # str = re.sub(r"""^"(?=\s)""", r"""&#8220;""", str)
+        # str = re.sub(r"""^'(?=\s)""", r"""&#8216;""", str)
+
+        str = self.opening_single_regex.sub(r"""\1""" + self.lsquo, str)
+        str = closing_single_regex.sub(r"""\1""" + self.rsquo, str)
+        str = closing_single_s_regex.sub(r"""\1""" + self.rsquo + r"""\2""", str)
+        str = closing_single_space_regex.sub(self.rsquo, str)
+
+        # Any remaining single quotes should be opening ones:
+        str = str.replace("'", self.lsquo)
+
+        str = self.opening_double_regex.sub(r"""\1""" + self.ldquo, str)
+
+        # Double closing quotes:
+        str = closing_double_space_regex.sub(self.rdquo, str)
+        str = closing_double_regex.sub(r"""\1""" + self.rdquo, str)
+
+        if str.endswith('-"'):
+            # A string that endswith -" is sometimes used for dialogue
+            str = str[:-1] + self.rdquo
+
+        # Any remaining quotes should be opening ones.
+        str = str.replace('"', self.ldquo)
+
+        return str
+
+    def scan_quotes(self, str):
+        """
+        The same as educate_quotes(), in one pass over the quotes in str,
+        each given the entity of the first substitution there that would
+        apply to it. Which one that is depends on nothing but the
+        characters either side of the quote, so it is looked up by them.
+
+        That holds unless one substitution can change or use up what a later
+        one looks at, see entangled_quotes_regex, or there is a measurement
+        (which takes a pair of quotes at once). Those are handed over to
+        educate_quotes().
+        """
+        if entangled_quotes_regex.search(str) or (measurement_quotes_regex.search(str) and
+                                                   measurement_regex.search(str)):
+            return self.educate_quotes(str)
+
+        if self.apos_regex is not None:
+            str = self.apos_regex.sub(self.rsquo, str)
+
+        # Quotes at the odd indexes, with the text around them either side
+        parts = quote_split_regex.split(str)
+        quote_marks = self.quote_marks
+        if len(quote_marks) > QUOTE_ENTITIES_CACHE_SIZE:
+            quote_marks.clear()
+        for i in range(1, len(parts), 2):
+            context = (parts[i - 1][-1:], parts[i], parts[i + 1][:3])
+            quote = quote_marks.get(context)
+            if quote is None:
+                quote = quote_entity(*context)
+                if self.use_unicode:
+                    quote = ENTITY_CHARS[quote]
+                quote_marks[context] = quote
+            parts[i] = quote
+        return "".join(parts)
+
+
+# Guards the caches below, which are shared by every thread
+_engines_lock = threading.Lock()
+
+# Compiled apostrophe exception matchers, shared by the engines for
+# every attr and ampersand that use the same words
+_apos_matchers = OrderedDict()
+APOS_CACHE_SIZE = 8
+
+def apos_matcher(words_list, ignore_case=False):
+    words = tuple(word for word in words_list if word)
+    if not words:
+        return None
+    key = (words, ignore_case)
+    with _engines_lock:
+        matcher = _apos_matchers.pop(key, None)
+        if matcher is None:
+            flags = re.I if ignore_case else 0
+            matcher = re.compile(r"'(?=%s\b)" % trie_pattern(words), flags)
+        _apos_matchers[key] = matcher
+        while len(_apos_matchers) > APOS_CACHE_SIZE:
+            _apos_matchers.popitem(last=False)
+    return matcher
+
+
+# Most recently used engines, keyed by their configuration
+_engines = OrderedDict()
+ENGINE_CACHE_SIZE = 16
+
+def get_engine(config=None):
+    if config is None:
+        config = SmartyPantsConfig()
+    with _engines_lock:
+        engine = _engines.pop(config, None)
+        if engine is not None:
+            _engines[config] = engine
+            return engine
+    # Two threads may both build the same engine, which is harmless
+    engine = SmartyPants(config)
+    with _engines_lock:
+        _engines[config] = engine
+        while len(_engines) > ENGINE_CACHE_SIZE:
+            _engines.popitem(last=False)
+    return engine
+
+
+class TokenCache(object):
+    """
+    Smartened text tokens, for books that have the same ones over and over
+    (scene breaks, running heads, lone quotes, bits of dialogue), so that
+    each is only worked out once. Kept for the tokens of up to
+    max_token_length characters, least recently used first out once the
+    tokens and results in it come to more than max_size characters.
+
+    Entries are keyed by the engine (so its config) and the token, along
+    with whether the text before it ends in a space for a lone quote, the
+    only token that depends on what comes before it. hits and misses count
+    the lookups. One cache can be shared by any number of engines and
+    threads.
+    """
+
+    def __init__(self, max_size=1000000, max_token_length=200):
+        self.max_size = max_size
+        self.max_token_length = max_token_length
+        self.size = 0
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, token, educated):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (len(token) + len(educated), educated)
+            self.size += len(token) + len(educated)
+            while self.size > self.max_size:
+                size, educated = self._entries.popitem(last=False)[1]
+                self.size -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def educateQuotes(str, ampersand='', words_list=None, apos_ignore_case=False):
+    """
+    Parameter:  String, plus what stands in for '&' and the apostrophe
+                exception words (see SmartyPantsConfig).
 
     Returns:    The string, with "educated" curly quote HTML entities.
 
     Example input:  "Isn't this fun?"
     Example output: &#8220;Isn&#8217;t this fun?&#8221;
     """
-
-    punct_class = r"""[!"#\$\%'()*+,-.\/:;<=>?\@\[\\\]\^_`{|}~]"""
-
-    """Do the words beginning with an apostrophe - in apos_exception.txt file"""
-    if apos_words_list:
-        # One on each line - WITHOUT the apostrophe
-        try:
-            for entry in apos_words_list:
-                str = re.sub(r"'("+entry+")\\b", '%s\\1' % r"""&#8217;""", str)  # , flags=re.I)
-        except:
-            print("Error processing apostrophe exceptions list!")
-            pass
-
-    # Special case if the very first character is a quote
-    # followed by punctuation at a non-word-break. Close the quotes by brute force:
-    str = re.sub(r"""^'(?=%s\\B)""" % (punct_class,), r"""&#8217;""", str, flags=re.U)
-    str = re.sub(r"""^"(?=%s\\B)""" % (punct_class,), r"""&#8221;""", str, flags=re.U)
-
-    # Special case for double sets of quotes, e.g.:
-    #   <p>He said, "'Quoted' words in a larger quote."</p>
-    str = re.sub(r""""'(?=\w)""", """&#8220;&#8216;""", str, flags=re.U)
-    str = re.sub(r"""'"(?=\w)""", """&#8216;&#8220;""", str, flags=re.U)
-    str = re.sub(r'''""(?=\w)''', """&#8220;&#8220;""", str, flags=re.U)
-    str = re.sub(r"""''(?=\w)""", """&#8216;&#8216;""", str, flags=re.U)
-    str = re.sub(r'''\"\'''',     """&#8221;&#8217;""", str)
-    str = re.sub(r'''\'\"''',     """&#8217;&#8221;""", str)
-    str = re.sub(r'''""''',       """&#8221;&#8221;""", str)
-    str = re.sub(r"""''""",       """&#8217;&#8217;""", str)
-
-    # Special case for decade abbreviations (the '80s --> ’80s):
-    # See http://practicaltypography.com/apostrophes.html
-    str = re.sub(r"""(\W|^)'(?=\d{2}s)""", r"""\1&#8217;""", str, flags=re.U)
-    # Measurements in feet and inches or longitude/latitude: 19' 43.5" --> 19′ 43.5″
-    str = re.sub(r'''(\W|^)([-0-9.]+\s*)'(\s*[-0-9.]+)"''', r'\1\2&#8242;\3&#8243;', str, flags=re.U)
-
-    # Special case for Quotes at inside of other entities, e.g.:
-    #   <p>A double quote--"within dashes"--would be nice.</p>
-    str = re.sub(r"""(?<=\W)"(?=\w)""", r"""&#8220;""", str, flags=re.U)
-    str = re.sub(r"""(?<=\W)'(?=\w)""", r"""&#8216;""", str, flags=re.U)
-    str = re.sub(r"""(?<=\w)"(?=\W)""", r"""&#8221;""", str, flags=re.U)
-    str = re.sub(r"""(?<=\w)'(?=\W)""", r"""&#8217;""", str, flags=re.U)
-
-    # The following are commented out as smartypants tokenizes text by
-    # stripping out html tags. Therefore, there is no guarantee that the
-    # start-of-line and end-ol-line regex operators will match anything
-    # meaningful
-
-    # Special case for Quotes at end of line with a preceeding space (may change just to end of line)
-    # str = re.sub(r"""(?<=\s)"$""", r"""&#8221;""", str)
-    # str = re.sub(r"""(?<=\s)'$""", r"""&#8217;""", str)
-
-    # Special case for Quotes at beginning of line with a space - multiparagraph quoted text:
-    # str = re.sub(r"""^"(?=\s)""", r"""&#8220;""", str)
-    # str = re.sub(r"""^'(?=\s)""", r"""&#8216;""", str)
-
-    close_class = r"""[^\ \t\r\n\[\{\(\-]"""
-    dec_dashes = r"""%s#8211;|%s#8212;""".format(AMP, AMP)
-
-    # Get most opening single quotes:
-    opening_single_quotes_regex = re.compile(r"""
-            (
-                \p{Zs}       |   # a whitespace char, or
-                %snbsp;      |   # a non-breaking space entity, or
-                %s\#160;     |
-                --           |   # dashes, or
-                %s[mn]dash;  |   # named dash entities
-                %s           |   # or decimal entities
-                %s\#x201[34];    # or hex
-            )
-            '                    # the quote
-            (?=\w)               # followed by a word character
-            """ % (AMP, AMP, AMP, dec_dashes, AMP,), re.VERBOSE | re.UNICODE)
-    str = opening_single_quotes_regex.sub(r"""\1&#8216;""", str)
-
-    closing_single_quotes_regex = re.compile(r"""
-            (%s)
-            '
-            (?!\p{Zs} | s\b | \d)
-            """ % (close_class,), re.VERBOSE | re.UNICODE)
-    str = closing_single_quotes_regex.sub(r"""\1&#8217;""", str)
-
-    closing_single_quotes_regex = re.compile(r"""
-            (%s)
-            '
-            (\p{Zs} | s\b)
-            """ % (close_class,), re.VERBOSE | re.UNICODE)
-    str = closing_single_quotes_regex.sub(r"""\1&#8217;\2""", str)
-
-    # Added by Doug {
-    closing_single_quotes_regex = re.compile(r"""
-            #(%s)?   # character that indicates the quote should be closing
-            '
-            (?=\p{Zs})
-            """ % (close_class,), re.VERBOSE | re.UNICODE)
-    str = closing_single_quotes_regex.sub(r"""&#8217;""", str)
-    # }
-
-    # Any remaining single quotes should be opening ones:
-    str = re.sub(r"""'""", r"""&#8216;""", str)
-
-    # Get most opening double quotes:
-    opening_double_quotes_regex = re.compile(r"""
-            (
-                \p{Zs}       |   # a whitespace char, or
-                %snbsp;      |   # a non-breaking space entity, or
-                %s\#160;     |
-                --           |   # dashes, or
-                %s[mn]dash;  |   # named dash entities
-                %s           |   # or decimal entities
-                %s\#x201[34];    # or hex
-            )
-            "                    # the quote
-            (?=\w)               # followed by a word character
-            """ % (AMP, AMP, AMP, dec_dashes, AMP,), re.VERBOSE | re.UNICODE)
-    str = opening_double_quotes_regex.sub(r"""\1&#8220;""", str)
-
-    # Double closing quotes:
-    closing_double_quotes_regex = re.compile(r"""
-            #(%s)?   # character that indicates the quote should be closing
-            "
-            (?=\p{Zs})
-            """ % (close_class,), re.VERBOSE | re.UNICODE)
-    str = closing_double_quotes_regex.sub(r"""&#8221;""", str)
-
-    closing_double_quotes_regex = re.compile(r"""
-            (%s)   # character that indicates the quote should be closing
-            "
-            """ % (close_class,), re.VERBOSE)
-    str = closing_double_quotes_regex.sub(r"""\1&#8221;""", str)
-
-    if str.endswith('-"'):
-        # A string that endswith -" is sometimes used for dialogue
-        str = str[:-1] + '&#8221;'
-
-    # Any remaining quotes should be opening ones.
-    str = re.sub(r'"', r"""&#8220;""", str)
-
-    return str
+    config = SmartyPantsConfig(default_smartypants_attr, ampersand, words_list, apos_ignore_case)
+    return get_engine(config).educate_quotes(str)
 
 
 def educateBackticks(str):
@@ -746,8 +1303,8 @@ def educateBackticks(str):
     Example output: &#8220;Isn't this fun?&#8221;
     """
 
-    str = re.sub(r"""``""", r"""&#8220;""", str)
-    str = re.sub(r"""''""", r"""&#8221;""", str)
+    for chars, repl in BACKTICK_RULES:
+        str = str.replace(chars, repl)
     return str
 
 
@@ -761,8 +1318,8 @@ def educateSingleBackticks(str):
     Example output: &#8216;Isn&#8217;t this fun?&#8217;
     """
 
-    str = re.sub(r"""`""", r"""&#8216;""", str)
-    str = re.sub(r"""'""", r"""&#8217;""", str)
+    for chars, repl in SINGLE_BACKTICK_RULES:
+        str = str.replace(chars, repl)
     return str
 
 
@@ -774,9 +1331,9 @@ def educateDashes(str):
                 an em-dash HTML entity.
     """
 
-    str = re.sub(r"""---""", r"""^tripledash^""", str)  # protect triple dashes
-    str = re.sub(r"""--""", r"""&#8212;""", str)  # em
-    str = re.sub(r"""\^tripledash\^""", r"""---""", str)  # put triple dashes back
+    str = str.replace("---", r"""^tripledash^""")  # protect triple dashes
+    str = str.replace("--", r"""&#8212;""")  # em
+    str = str.replace("^tripledash^", r"""---""")  # put triple dashes back
     return str
 
 
@@ -789,8 +1346,8 @@ def educateDashesOldSchool(str):
                 an em-dash HTML entity.
     """
 
-    str = re.sub(r"""---""", r"""&#8212;""", str)    # em (yes, backwards)
-    str = re.sub(r"""--""", r"""&#8211;""", str)    # en (yes, backwards)
+    str = str.replace("---", r"""&#8212;""")    # em (yes, backwards)
+    str = str.replace("--", r"""&#8211;""")    # en (yes, backwards)
     return str
 
 
@@ -809,8 +1366,8 @@ def educateDashesOldSchoolInverted(str):
                 the shortcut should be shorter to type. (Thanks to Aaron
                 Swartz for the idea.)
     """
-    str = re.sub(r"""---""", r"""&#8211;""", str)    # en
-    str = re.sub(r"""--""", r"""&#8212;""", str)    # em
+    str = str.replace("---", r"""&#8211;""")    # en
+    str = str.replace("--", r"""&#8212;""")    # em
     return str
 
 
@@ -824,9 +1381,9 @@ def educateEllipses(str):
     Example output: Huh&#8230;?
     """
 
-    str = re.sub(r"""\.\.\.""", r"""&#8230;""", str)
+    str = str.replace("...", r"""&#8230;""")
     # str = re.sub(r"""\. \. \.""", r"""&#8230;""", str)
-    str = re.sub(r"""\.\p{Zs}\.\p{Zs}\.""", r"""&#8230;""", str, flags=re.UNICODE)
+    str = spaced_ellipsis_regex.sub(r"""&#8230;""", str)
     return str
 
 
@@ -840,16 +1397,16 @@ def stupefyEntities(str):
     Example output: "Hello -- world."
     """
 
-    str = re.sub(r"""&#8211;""", r"""-""", str)  # en-dash
-    str = re.sub(r"""&#8212;""", r"""--""", str)  # em-dash
+    str = str.replace(r"""&#8211;""", r"""-""")  # en-dash
+    str = str.replace(r"""&#8212;""", r"""--""")  # em-dash
 
-    str = re.sub(r"""&#8216;""", r"""'""", str)  # open single quote
-    str = re.sub(r"""&#8217;""", r"""'""", str)  # close single quote
+    str = str.replace(r"""&#8216;""", r"""'""")  # open single quote
+    str = str.replace(r"""&#8217;""", r"""'""")  # close single quote
 
-    str = re.sub(r"""&#8220;""", r'''"''', str)  # open double quote
-    str = re.sub(r"""&#8221;""", r'''"''', str)  # close double quote
+    str = str.replace(r"""&#8220;""", r'''"''')  # open double quote
+    str = str.replace(r"""&#8221;""", r'''"''')  # close double quote
 
-    str = re.sub(r"""&#8230;""", r"""...""", str)  # ellipsis
+    str = str.replace(r"""&#8230;""", r"""...""")  # ellipsis
 
     return str
 
@@ -870,46 +1427,41 @@ def processEscapes(str):
                 \-      &#45;
                 \`      &#96;
     """
-    str = re.sub(r"""\\\\""", r"""&#92;""", str)
-    str = re.sub(r'''\\"''', r"""&#34;""", str)
-    str = re.sub(r"""\\'""", r"""&#39;""", str)
-    str = re.sub(r"""\\\.""", r"""&#46;""", str)
-    str = re.sub(r"""\\-""", r"""&#45;""", str)
-    str = re.sub(r"""\\`""", r"""&#96;""", str)
+    str = str.replace('\\\\', r"""&#92;""")
+    str = str.replace('\\"', r"""&#34;""")
+    str = str.replace("\\'", r"""&#39;""")
+    str = str.replace('\\.', r"""&#46;""")
+    str = str.replace('\\-', r"""&#45;""")
+    str = str.replace('\\`', r"""&#96;""")
 
     return str
 
 
+# depth = 6
+# nested_tags = "|".join(['(?:<(?:[^<>]',] * depth) + (')*>)' * depth)
+# match = r"""(?: <! ( -- .*? -- \s* )+ > ) |  # comments
+# (?: <\? .*? \?> ) |  # directives
+# %s  # nested tags       """ % (nested_tags,)
+# tag_soup = re.compile(r"""([^<]*)(<[^>]*>)""")
+tag_soup = re.compile(r"""([^<]*)(<!--.*?--\s*>|<[^>]*>)""", re.S)
+
 def _tokenize(str):
     """
     Parameter:  String containing HTML markup.
-    Returns:    Reference to an array of the tokens comprising the input
-                string. Each token is either a tag (possibly with nested,
-                tags contained therein, such as <a href="<MTFoo>">, or a
-                run of text between tags. Each element of the array is a
-                two-element array; the first is either 'tag' or 'text';
-                the second is the actual value.
+    Yields:     The tokens comprising the input string, in order. Each
+                token is either a tag (possibly with nested, tags contained
+                therein, such as <a href="<MTFoo>">, or a run of text
+                between tags. Each is a (type, value) tuple; the type is
+                either 'tag' or 'text', the value is the actual text.
 
     Based on the _tokenize() subroutine from Brad Choate's MTRegex plugin.
         <http://www.bradchoate.com/past/mtregex.php>
     """
 
-    tokens = []
-
-    # depth = 6
-    # nested_tags = "|".join(['(?:<(?:[^<>]',] * depth) + (')*>)' * depth)
-    # match = r"""(?: <! ( -- .*? -- \s* )+ > ) |  # comments
-    # (?: <\? .*? \?> ) |  # directives
-    # %s  # nested tags       """ % (nested_tags,)
-    # tag_soup = re.compile(r"""([^<]*)(<[^>]*>)""")
-    tag_soup = re.compile(r"""([^<]*)(<!--.*?--\s*>|<[^>]*>)""", re.S)
-
-    token_match = tag_soup.search(str)
-
     previous_end = 0
-    while token_match is not None:
+    for token_match in tag_soup.finditer(str):
         if token_match.group(1):
-            tokens.append(['text', token_match.group(1)])
+            yield ('text', token_match.group(1))
 
         tag = token_match.group(2)
         type_ = 'tag'
@@ -917,58 +1469,135 @@ def _tokenize(str):
             # remove --[white space]> from the end of tag
             if '--' in tag[4:].rstrip('>').rstrip().rstrip('-'):
                 type_ = 'text'
-        tokens.append([type_, tag])
+        yield (type_, tag)
 
         previous_end = token_match.end()
-        token_match = tag_soup.search(str, token_match.end())
 
     if previous_end < len(str):
-        tokens.append(['text', str[previous_end:]])
-
-    return tokens
+        yield ('text', str[previous_end:])
 
 def run_tests():
     import unittest
-    sp = smartyPants
 
     class TestSmartypantsAllAttributes(unittest.TestCase):
         # the default attribute is "1", which means "all".
+        quote_engine = QUOTES_REGEX
+
+        def sp(self, text):
+            return smartyPants(text, quote_engine=self.quote_engine)
 
         def test_dates(self):
-            self.assertEqual(sp("one two '60s"), "one two &#8217;60s")
-            self.assertEqual(sp("1440-80's"), "1440-80&#8217;s")
-            self.assertEqual(sp("1440-'80s"), "1440-&#8217;80s")
-            self.assertEqual(sp("1440---'80s"), "1440&#8211;&#8217;80s")
-            self.assertEqual(sp("1960s"), "1960s")  # no effect.
-            self.assertEqual(sp("1960's"), "1960&#8217;s")
-            self.assertEqual(sp("one two '60s"), "one two &#8217;60s")
-            self.assertEqual(sp("'60s"), "&#8217;60s")
+            self.assertEqual(self.sp("one two '60s"), "one two &#8217;60s")
+            self.assertEqual(self.sp("1440-80's"), "1440-80&#8217;s")
+            self.assertEqual(self.sp("1440-'80s"), "1440-&#8217;80s")
+            self.assertEqual(self.sp("1440---'80s"), "1440&#8211;&#8217;80s")
+            self.assertEqual(self.sp("1960s"), "1960s")  # no effect.
+            self.assertEqual(self.sp("1960's"), "1960&#8217;s")
+            self.assertEqual(self.sp("one two '60s"), "one two &#8217;60s")
+            self.assertEqual(self.sp("'60s"), "&#8217;60s")
 
         def test_measurements(self):
             ae = self.assertEqual
-            ae(sp("one two 1.1'2.2\""), "one two 1.1&#8242;2.2&#8243;")
-            ae(sp("1' 2\""), "1&#8242; 2&#8243;")
+            ae(self.sp("one two 1.1'2.2\""), "one two 1.1&#8242;2.2&#8243;")
+            ae(self.sp("1' 2\""), "1&#8242; 2&#8243;")
 
         def test_skip_tags(self):
             self.assertEqual(
-                sp("""<script type="text/javascript">\n<!--\nvar href = "http://www.google.com";\nvar linktext = "google";\ndocument.write('<a href="' + href + '">' + linktext + "</a>");\n//-->\n</script>"""),  # noqa
+                self.sp("""<script type="text/javascript">\n<!--\nvar href = "http://www.google.com";\nvar linktext = "google";\ndocument.write('<a href="' + href + '">' + linktext + "</a>");\n//-->\n</script>"""),  # noqa
                    """<script type="text/javascript">\n<!--\nvar href = "http://www.google.com";\nvar linktext = "google";\ndocument.write('<a href="' + href + '">' + linktext + "</a>");\n//-->\n</script>""")  # noqa
             self.assertEqual(
-                sp("""<p>He said &quot;Let's write some code.&quot; This code here <code>if True:\n\tprint &quot;Okay&quot;</code> is python code.</p>"""),
+                self.sp("""<p>He said &quot;Let's write some code.&quot; This code here <code>if True:\n\tprint &quot;Okay&quot;</code> is python code.</p>"""),
                    """<p>He said &#8220;Let&#8217;s write some code.&#8221; This code here <code>if True:\n\tprint &quot;Okay&quot;</code> is python code.</p>""")  # noqa
 
             self.assertEqual(
-                sp('''<script/><p>It's ok</p>'''),
+                self.sp('''<script/><p>It's ok</p>'''),
                 '''<script/><p>It&#8217;s ok</p>''')
 
         def test_ordinal_numbers(self):
-            self.assertEqual(sp("21st century"), "21st century")  # no effect.
-            self.assertEqual(sp("3rd"), "3rd")  # no effect.
+            self.assertEqual(self.sp("21st century"), "21st century")  # no effect.
+            self.assertEqual(self.sp("3rd"), "3rd")  # no effect.
 
         def test_educated_quotes(self):
-            self.assertEqual(sp('''"Isn't this fun?"'''), '''&#8220;Isn&#8217;t this fun?&#8221;''')
-
-    tests = unittest.defaultTestLoader.loadTestsFromTestCase(TestSmartypantsAllAttributes)
+            self.assertEqual(self.sp('''"Isn't this fun?"'''), '''&#8220;Isn&#8217;t this fun?&#8221;''')
+
+        def test_opaque_entities(self):
+            sp = get_engine(SmartyPantsConfig(ampersand='&', words_list=['tis'], quote_engine=self.quote_engine)).process
+            self.assertEqual(sp('''&quot;Stop.'&nbsp;"Go&hellip;" &amp; 'tis&mdash;'''),
+                             '''&quot;Stop.&#8217;&nbsp;&#8220;Go&hellip;&#8221; &amp; &#8217;tis&mdash;''')
+            self.assertEqual(get_engine(SmartyPantsConfig('-1', '&')).process('&#8220;x&#8221;'), '&#8220;x&#8221;')
+
+        def test_token_cache(self):
+            engine = get_engine(SmartyPantsConfig(quote_engine=self.quote_engine))
+            cache = TokenCache(max_size=40)
+            text = """<p>"</p><p>* * *</p><p>Hi "<i>'</i>"</p><p>* * *</p><p>"</p><p>x '</p><p>"</p>"""
+            stats = {}
+            self.assertEqual(engine.process(text, stats=stats, cache=cache), engine.process(text))
+            self.assertEqual((cache.hits, cache.misses, stats['cached']), (2, 5, 2))
+            self.assertTrue(cache.size <= 40)
+            # &quot; becomes a lone quote, so the text before it counts too
+            text = """<p>x</p><i>&quot;</i><p>x </p><i>&quot;</i>"""
+            self.assertEqual(engine.process(text, cache=cache), engine.process(text))
+
+        def test_unicode(self):
+            sp = get_engine(SmartyPantsConfig(ampersand='&', quote_engine=self.quote_engine, use_unicode=True)).process
+            self.assertEqual(sp('''"It's"--&#8220;6' 2"&#8221;... \\'\\-\\-\\.'''),
+                             u'''“It’s”—&#8220;6′ 2″&#8221;… '--.''')
+
+    # Dialogue and other quotes, for comparing the quotes engines
+    golden_corpus = (
+        """<p>"Isn't this fun?" she asked. "I don't think so," he said.</p>""",
+        """<p>'Come here,' said Mary. 'No,' said John, 'I won't.'</p>""",
+        """<p>He said, "'Quoted' words in a larger quote."</p>""",
+        """<p>"She told me 'never again,'" he whispered.</p>""",
+        """<p>'Twas the night before Christmas, and 'tis the season for 'em.</p>""",
+        """<p>Rock 'n' roll was born in the '50s, or was it the 1940's?</p>""",
+        """<p>The dogs' bones and the dog's bone and James' hat.</p>""",
+        """<p>He's 6' 2" tall, and the board is 19' 43.5" long.</p>""",
+        """<p>"Well--" "Don't." "But--" "No--"</p>""",
+        """<p>"Wait---what?" she cried. "I--I can't."</p>""",
+        """<p>He trailed off... "And then?" "And then. . . nothing."</p>""",
+        """<p>&quot;Entities&quot; are 'handled' too &mdash; "mostly".</p>""",
+        """<p>"&nbsp;Spaced out&nbsp;" and '&#160;so on&#160;'</p>""",
+        """<p>&#8212;"Dashed" and &#x2014;'dashed' and &ndash;'en'</p>""",
+        """<p> "Non-breaking" 'spaces' everywhere "</p>""",
+        """<p>("Parenthetical") ['bracketed'] {"braced"}</p>""",
+        """<p>"<em>Emphasis</em>," she said, "<i>is</i> 'important.'"</p>""",
+        """<p><b>"</b>Split<b>"</b> and <b>'</b>split<b>'</b></p>""",
+        """<p>"Multi-paragraph quotes</p><p>"continue like this."</p>""",
+        """<p>'Single-quoted dialogue,' UK style. 'Again?' 'Again.'</p>""",
+        """<p>"Numbers like '99 and '05," he said, "or 3'4"."</p>""",
+        """<p>Escapes: \\"straight\\" and \\'straight\\' and \\-\\.\\`</p>""",
+        """<p>``Backticks'' and `single backticks' and ''empty''</p>""",
+        """<p>"'Nested,' she said," he said, "'twice.'"</p>""",
+        """<p>The '90s' music; the 90's' hits; y'all; o'clock; ma'am.</p>""",
+        """<p>"Tab\t" and "newline\n" and 'line\r\nend'</p>""",
+        """<p>"'" and '"' and "" and '' on their own.</p>""",
+        """<p>She said "yes"-and then "no"-"</p>""",
+        """<p>"Ended with a dash-"</p>""",
+        """<p>Café "crème" and naïve 'résumé' in Ünïcödé.</p>""",
+        """<pre>"Pre" is 'left' alone</pre><p>but "this" isn't</p>""",
+        """<code>"code"</code> <kbd>'kbd'</kbd> <script>var s = "x";</script>""",
+        """<p>'.' and ".", '!' and "?"; ',' and ";"</p>""",
+        """<p>'$5' and "#hash" and '@at' and "%per" and '*star*'</p>""",
+        """<p>The Jones's' house, the bass's 'sound', a ' b</p>""",
+        """<p>Quotes "at the very end"</p><p>'And the start</p>""",
+    )
+
+    class TestSmartypantsScanQuotes(TestSmartypantsAllAttributes):
+        # the same again, with the character scanning quotes engine
+        quote_engine = QUOTES_SCAN
+
+        def test_golden_corpus(self):
+            # which has to give just what the regex one does
+            for text in golden_corpus:
+                for attr in ("1", "2", "qe", "qB"):
+                    for words_list in (None, ['tis', 'twas', 'em', 'n']):
+                        self.assertEqual(smartyPants(text, attr, words_list=words_list, quote_engine=QUOTES_SCAN),
+                                         smartyPants(text, attr, words_list=words_list), text)
+
+    tests = unittest.TestSuite()
+    for case in (TestSmartypantsAllAttributes, TestSmartypantsScanQuotes):
+        tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(case))
     unittest.TextTestRunner(verbosity=4).run(tests)
 
 
@@ -31,6 +31,8 @@ PLUGIN_FILES = ['__init__.py',
             'main.py',
             'plugin-import-name-diaps_toolbag.txt',
             'span_div_config.py',
+            'tag_index.py',
+            'tasks.py',
             'utilities.py'
 ]
 
@@ -10,12 +10,12 @@ import os
 import math
 
 try:
-    from qt.core import (Qt, QLabel, QLineEdit, QGroupBox, QVBoxLayout, QHBoxLayout, QPushButton, QDialogButtonBox)
+    from qt.core import (Qt, QLabel, QLineEdit, QCheckBox, QGroupBox, QVBoxLayout, QHBoxLayout, QPushButton, QDialogButtonBox)
 except ImportError:
     try:
-        from PyQt5.Qt import (Qt, QLabel, QLineEdit, QGroupBox, QVBoxLayout, QHBoxLayout, QPushButton, QDialogButtonBox)
+        from PyQt5.Qt import (Qt, QLabel, QLineEdit, QCheckBox, QGroupBox, QVBoxLayout, QHBoxLayout, QPushButton, QDialogButtonBox)
     except ImportError:
-        from PyQt4.Qt import (Qt, QLabel, QLineEdit, QGroupBox, QVBoxLayout, QHBoxLayout, QPushButton, QDialogButtonBox)
+        from PyQt4.Qt import (Qt, QLabel, QLineEdit, QCheckBox, QGroupBox, QVBoxLayout, QHBoxLayout, QPushButton, QDialogButtonBox)
 
 from calibre.utils.config import JSONConfig
 from calibre.gui2 import question_dialog
@@ -48,6 +48,7 @@ for tag in TAGLIST:
     plugin_prefs.defaults['{}_changes'.format(tag)] = CHANGE_TO_MAP[tag]
 plugin_prefs.defaults['attrs'] = ATTRS_LIST
 plugin_prefs.defaults['taglist'] = TAGLIST
+plugin_prefs.defaults['verbatim'] = False
 
 class ConfigWidget(Dialog):
     def __init__(self, gui):
@@ -128,6 +129,14 @@ class ConfigWidget(Dialog):
         attrs_layout.addWidget(labelattrs)
         attrs_layout.addWidget(self.attrs_txtBox)
 
+        layout.addSpacing(10)
+        self.verbatim_check = QCheckBox(_('Leave tags that do not match untouched'), self)
+        self.verbatim_check.setToolTip('<p>{}'.format(_('Only rewrite the tags that match (and their closing tags). '
+                                                         'When unchecked, every tag in the file is rebuilt, which also '
+                                                         'normalizes its attribute quoting and spacing.')))
+        self.verbatim_check.setChecked(plugin_prefs['verbatim'])
+        layout.addWidget(self.verbatim_check)
+
         layout.addSpacing(10)
         right_layout = QHBoxLayout()
         right_layout.setAlignment(Qt.AlignRight)
@@ -156,6 +165,7 @@ class ConfigWidget(Dialog):
         tmp_list = text_type(self.tags_txtBox.displayText()).split(',')
         tmp_list = [x.strip(' ') for x in tmp_list]
         plugin_prefs['taglist']= list(filter(None, tmp_list))
+        plugin_prefs['verbatim'] = self.verbatim_check.isChecked()
         self.accept()
 
     def reset_defaults(self):
@@ -167,4 +177,5 @@ class ConfigWidget(Dialog):
                 plugin_prefs['{}_changes'.format(tag)] = CHANGE_TO_MAP[tag]
             plugin_prefs['attrs'] = ATTRS_LIST
             plugin_prefs['taglist'] = TAGLIST
+            plugin_prefs['verbatim'] = False
             self.accept()
@@ -0,0 +1,204 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+# A book-wide index of the values the attributes of each tag have, and how
+# often each comes up in each file. It is built the first time it's asked
+# for, in a single pass over the book's (x)html files on a background
+# thread, and kept while the same book is being edited. After that only the
+# files changed since (or marked dirty) are read again.
+
+import os
+import threading
+import time
+
+from calibre.ebooks.oeb.polish.container import OEB_DOCS
+
+from calibre_plugins.diaps_toolbag.resources.html_parser import RuleSet
+from calibre_plugins.diaps_toolbag.tasks import tag_values
+
+
+class Cancelled(Exception):
+    pass
+
+class TagIndex(object):
+    # A file written this close (in seconds) to when it was read may have been
+    # changed again without its modification time changing, so it's read again
+    RECENT = 2
+
+    def __init__(self, container):
+        self.container = container
+        self.book = getattr(container, 'path_to_ebook', None)
+        # (tag, attribute) -> {value: {name: count}}, with (tag, None) -> {None: {...}}
+        # for the tags with no attributes
+        self.values = {}
+        # name -> (signature, tag_values() of the file) for each file tallied
+        self.files = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.cancel_event = threading.Event()
+        self.error = None
+
+    def names(self):
+        return [name for name, mt in self.container.mime_map.items() if mt in OEB_DOCS]
+
+    # A file's tally is good for as long as this stays the same. Files with
+    # changes not yet written out are always read again, as are those written
+    # just before they were read (when given the time they were read).
+    def signature(self, name, read_at=None):
+        container = self.container
+        if name in container.dirtied:
+            return None
+        try:
+            st = os.stat(container.name_path_map[name])
+        except (KeyError, EnvironmentError):
+            return None
+        if read_at is not None and st.st_mtime >= read_at - self.RECENT:
+            return None
+        # to the nanosecond where there's a choice (not on python 2)
+        return st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime)
+
+    def is_stale(self, name):
+        tallied = self.files.get(name)
+        return tallied is None or tallied[0] is None or tallied[0] != self.signature(name)
+
+    # forget the tallies of files that have been changed
+    def invalidate(self, names):
+        with self.lock:
+            for name in names:
+                if name in self.files:
+                    self.files[name] = (None, self.files[name][1])
+
+    def _drop(self, name):
+        sig, counts = self.files.pop(name, (None, {}))
+        for (tag, attrib, value), count in counts.items():
+            values = self.values[(tag, attrib)]
+            names = values[value]
+            del names[name]
+            if not names:
+                del values[value]
+                if not values:
+                    del self.values[(tag, attrib)]
+
+    def _add(self, name, sig, counts):
+        self.files[name] = (sig, counts)
+        for (tag, attrib, value), count in counts.items():
+            self.values.setdefault((tag, attrib), {}).setdefault(value, {})[name] = count
+
+    # The text of a file. One calibre holds parsed is serialized from its tree,
+    # as raw_data() would write it out and drop the tree, from this thread.
+    def read(self, name):
+        container = self.container
+        if name in container.parsed_cache:
+            return container.decode(container.serialize_item(name))
+        return container.raw_data(name)
+
+    # read the files that are new or changed since they were last tallied
+    def update(self, checkpoint=None):
+        names = self.names()
+        with self.lock:
+            for name in set(self.files) - set(names):
+                self._drop(name)
+        for name in names:
+            if checkpoint is not None:
+                checkpoint()
+            with self.lock:
+                if not self.is_stale(name):
+                    continue
+            # taken before reading, so a change made while reading shows up next time
+            sig = self.signature(name, time.time())
+            counts = tag_values(self.read(name), checkpoint)
+            with self.lock:
+                self._drop(name)
+                self._add(name, sig, counts)
+
+    def checkpoint(self):
+        if self.cancel_event.is_set():
+            raise Cancelled()
+
+    def run(self):
+        try:
+            self.update(self.checkpoint)
+        except Cancelled:
+            pass
+        except Exception:
+            import traceback
+            self.error = traceback.format_exc()
+
+    # bring the index up to date on a background thread
+    def start(self):
+        if self.busy():
+            return
+        self.cancel_event.clear()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='TagIndex')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # stop the background thread (after the file it is on), before the
+    # book is changed. What it hadn't got to is done the next time.
+    def cancel(self):
+        if self.thread is not None:
+            self.cancel_event.set()
+            self.thread.join()
+            self.thread = None
+
+    # the values a tag's attribute has anywhere in the book
+    def values_of(self, tag, attrib):
+        with self.lock:
+            return sorted(self.values.get((tag, attrib), ()))
+
+    # the {name: count} of each value of a rule's tag and attribute that it matches
+    def _matched(self, rule):
+        for value, names in self.values.get((rule.tag, rule.attrib), {}).items():
+            if rule.matches({} if rule.attrib is None else {rule.attrib: value}):
+                yield names
+
+    # How many tags a CompiledCriteria matches, and in how many files, as far
+    # as the files tallied go
+    def count(self, rule):
+        total = 0
+        found = set()
+        with self.lock:
+            for names in self._matched(rule):
+                total += sum(names.values())
+                found.update(names)
+        return total, len(found)
+
+    # The files a CompiledCriteria or RuleSet could change: the files with a
+    # tag one of its rules matches (a rule can only match what is in the file,
+    # or what a rule before it made), and those not tallied since they changed
+    def candidates(self, criteria):
+        rules = criteria if isinstance(criteria, RuleSet) else RuleSet([criteria])
+        found = set()
+        with self.lock:
+            for rule in rules.rules:
+                for names in self._matched(rule):
+                    found.update(names)
+            found.update(name for name in self.names() if self.is_stale(name))
+        return found
+
+
+_index = None
+
+# The index of the book a container is for. A new container is made for the
+# same book at every savepoint, with its files copied as they were, so the
+# tallies are kept and just checked against the new container's files.
+def get_index(container):
+    global _index
+    if _index is not None and _index.book != getattr(container, 'path_to_ebook', None):
+        _index.cancel()
+        _index = None
+    if _index is None:
+        _index = TagIndex(container)
+    elif _index.container is not container:
+        _index.cancel()
+        _index.container = container
+    return _index
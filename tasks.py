@@ -0,0 +1,242 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+# The per-file work of the tools. Everything here is a plain function of a
+# file's text and the criteria, so that it can be handed to a worker thread
+# as well as called directly. Nothing GUI related belongs here. An optional checkpoint callable is called regularly while a
+# file is worked on, and can raise to abandon it.
+
+import re
+
+from calibre_plugins.diaps_toolbag.resources.html_parser import (MarkupParser, RuleSet, REMOVE, CHANGE, BEGIN_TYPES,
+                                                                  apply_edits)
+from calibre_plugins.diaps_toolbag.resources.smartypants import (SmartyPantsConfig, get_engine, QUOTES_REGEX,
+                                                                  QUOTES_SCAN, TokenCache, tags_to_skip)
+
+
+def delete_modify(data, criteria, checkpoint=None):
+    _parser = MarkupParser(data, criteria=criteria, checkpoint=checkpoint)
+
+    # Only build a new string when there is something to change. Hand back the
+    # changed (start, end) ranges of the original text along with it.
+    edits = _parser.edits()
+    if not edits:
+        return data, []
+    return apply_edits(data, edits), [(start, end) for start, end, repl in edits]
+
+# How often each (tag, attribute, value) comes up in the begin tags of a
+# file, with (tag, None, None) for tags with no attributes at all. Tags are
+# read just as delete_modify reads them, so a rule matches a tag exactly
+# when it matches one of that tag's entries here.
+def tag_values(data, checkpoint=None):
+    parser = MarkupParser(data)
+    counts = {}
+    for text, tag in parser.iterml():
+        if not tag:
+            continue
+        if checkpoint is not None:
+            checkpoint()
+        ttype, tname, tattr = parser.parsetag(tag)
+        if ttype not in BEGIN_TYPES:
+            continue
+        if not tattr:
+            key = (tname, None, None)
+            counts[key] = counts.get(key, 0) + 1
+        for aname, value in tattr.items():
+            key = (tname, aname, value)
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+# Raised by delete_modify_tree, before it has changed anything, for an edit
+# a file's parsed tree can't be given. That file is done by delete_modify on
+# its text instead.
+class TreeUnsupported(ValueError):
+    pass
+
+
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+XML_NAME = re.compile(r'^[^\W\d][\w.-]*$', re.U)
+XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# the compiled XPath of each RuleSet.xpath() expression used so far
+_selectors = {}
+
+def tree_selector(rules):
+    expr, variables = rules.xpath()
+    selector = _selectors.get(expr)
+    if selector is None:
+        from lxml import etree
+        selector = _selectors[expr] = etree.XPath(expr)
+    return selector, variables
+
+# an lxml attribute key ('{uri}name' when namespaced) as the markup has it
+def attr_qname(elem, key):
+    if not key.startswith('{'):
+        return key
+    uri, name = key[1:].split('}', 1)
+    if uri == XML_NS:
+        return 'xml:' + name
+    for prefix, ns in elem.nsmap.items():
+        if ns == uri and prefix:
+            return prefix + ':' + name
+    raise TreeUnsupported('No prefix for the attribute {0}'.format(key))
+
+# and back again, for the attributes a changed element is given
+def attr_key(elem, qname, value):
+    prefix, colon, name = qname.rpartition(':')
+    if not XML_NAME.match(name) or XML_INVALID.search(value):
+        raise TreeUnsupported('Cannot set the attribute {0}="{1}"'.format(qname, value))
+    if not colon:
+        return name
+    uri = XML_NS if prefix == 'xml' else elem.nsmap.get(prefix)
+    if uri is None:
+        raise TreeUnsupported('Unknown prefix in the attribute {0}'.format(qname))
+    return '{%s}%s' % (uri, name)
+
+# take an element out of the tree, leaving its text and children in its place
+def unwrap(elem):
+    parent = elem.getparent()
+    children = list(elem)
+    text = elem.text or ''
+    if elem.tail:
+        if children:
+            children[-1].tail = (children[-1].tail or '') + elem.tail
+        else:
+            text += elem.tail
+    if text:
+        previous = elem.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + text
+        else:
+            parent.text = (parent.text or '') + text
+    i = parent.index(elem)
+    parent[i:i + 1] = children
+
+# delete_modify() for the parsed (lxml) tree of a file, which is changed in
+# place. A compiled XPath picks out the elements a rule matches, rather than
+# every tag of the file being looked at. Removed elements are unwrapped,
+# changed ones are renamed and given their new attributes. Returns whether
+# anything was changed, along with how many elements were.
+def delete_modify_tree(root, criteria, checkpoint=None):
+    rules = criteria if isinstance(criteria, RuleSet) else RuleSet([criteria])
+    selector, variables = tree_selector(rules)
+    # Everything is worked out before anything is changed, so that a tree
+    # that can't be given the edit is left as it was
+    edits = []
+    for elem in selector(root, **variables):
+        if checkpoint is not None:
+            checkpoint()
+        attrs = dict((attr_qname(elem, key), value) for key, value in elem.items())
+        ns, brace, tname = elem.tag.rpartition('}')
+        flag, tname, tattr = rules.apply(tname, attrs)
+        if flag == REMOVE:
+            if elem.getparent() is None:
+                raise TreeUnsupported('Cannot remove the root element')
+            edits.append((elem, None, None))
+        elif flag == CHANGE:
+            if not XML_NAME.match(tname):
+                raise TreeUnsupported('Cannot rename an element to {0}'.format(tname))
+            tag = ns + brace + tname
+            attrib = None
+            if tattr is not attrs:
+                attrib = dict((attr_key(elem, qname, value), value) for qname, value in tattr.items())
+                if attrib == dict(elem.attrib):
+                    attrib = None
+            if tag != elem.tag or attrib is not None:
+                edits.append((elem, tag, attrib))
+    for elem, tag, attrib in edits:
+        if tag is None:
+            unwrap(elem)
+            continue
+        elem.tag = tag
+        if attrib is not None:
+            elem.attrib.clear()
+            for key, value in attrib.items():
+                elem.set(key, value)
+    return bool(edits), len(edits)
+
+
+# Text runs already smartened, for every file and run of the session (and
+# of each worker process), as books repeat a lot of the short ones
+_token_cache = TokenCache()
+
+def smarten_engine(criteria):
+    smarty_attr, use_unicode, apos_words_list, apos_ignore_case, scan_quotes = criteria
+    quote_engine = QUOTES_SCAN if scan_quotes else QUOTES_REGEX
+    # The engine leaves the entities already in the text alone, and writes
+    # what it makes as characters when asked to
+    return get_engine(SmartyPantsConfig(smarty_attr, '&', apos_words_list, apos_ignore_case, quote_engine,
+                                        use_unicode))
+
+def smarten(data, criteria, checkpoint=None):
+    engine = smarten_engine(criteria)
+
+    # How many text runs there were, how many had nothing to smarten, and
+    # how many were smartened before
+    stats = {'tokens': 0, 'skipped': 0, 'cached': 0}
+    htmlstr = engine.process(data, checkpoint, stats, _token_cache)
+    return htmlstr, stats
+
+# The (element, 'text' or 'tail') places of the text of a parsed document, in
+# document order, less comments and the like. The elements smartypants skips
+# come as (element, None), for the text inside them to be read but not changed.
+def text_nodes(root):
+    nodes = []
+    if root.text:
+        nodes.append((root, 'text'))
+    stack = [(root, iter(root))]
+    while stack:
+        elem, children = stack[-1]
+        for child in children:
+            if callable(child.tag):
+                pass
+            elif child.tag.rpartition('}')[2].lower() not in tags_to_skip:
+                if child.text:
+                    nodes.append((child, 'text'))
+                stack.append((child, iter(child)))
+                break
+            elif any(child.itertext()):
+                nodes.append((child, None))
+            if child.tail:
+                nodes.append((child, 'tail'))
+        else:
+            stack.pop()
+            if stack and elem.tail:
+                nodes.append((elem, 'tail'))
+    return nodes
+
+# smarten() for the parsed (lxml) tree of a file, which is changed in place.
+# Its text holds characters rather than entities, so that is what is written.
+# Returns whether anything was changed, along with the stats.
+def smarten_tree(root, criteria, checkpoint=None):
+    engine = smarten_engine(tuple(criteria[:1]) + (True,) + tuple(criteria[2:]))
+    stats = {'tokens': 0, 'skipped': 0, 'cached': 0}
+    if engine.attr == '0':
+        return False, stats
+    # The text inside a skipped element goes in between its tags, as it
+    # would from the markup: left as it is, but what the next quote follows
+    targets = []
+    tokens = []
+    for elem, place in text_nodes(root):
+        if place is None:
+            tag = elem.tag.rpartition('}')[2].lower()
+            targets.extend(((None, None), (None, None), (None, None)))
+            tokens.extend((('tag', '<%s>' % tag), ('text', ''.join(elem.itertext())), ('tag', '</%s>' % tag)))
+        else:
+            targets.append((elem, place))
+            tokens.append(('text', getattr(elem, place)))
+    # all of it worked out before the tree is touched, so a run cancelled
+    # part way through leaves it as it was
+    smartened = list(engine.educate_tokens(tokens, checkpoint, stats, _token_cache))
+    changed = False
+    for (elem, place), t in zip(targets, smartened):
+        if elem is not None and t != getattr(elem, place):
+            setattr(elem, place, t)
+            changed = True
+    return changed, stats
+